@@ -17,25 +17,230 @@ Usage:
 
 import os
 import argparse
+import atexit
 import logging
+import queue
 import sys
 import json
-import anthropic
+import base64
+import codecs
+import mmap
+import gzip
+import hashlib
+import re
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from github_agent import GitHubAgent
+from logging.handlers import QueueHandler, QueueListener
 
-# Configure logging
+# orjson is optional; fall back to the standard library parser
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Configure logging. Records are handed to a background thread through a
+# queue so file and console writes never block the caller.
+log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log_handlers = [logging.FileHandler("chapter_writer.log"), logging.StreamHandler()]
+for handler in log_handlers:
+    handler.setFormatter(log_formatter)
+log_queue = queue.Queue(-1)
+log_listener = QueueListener(log_queue, *log_handlers)
+log_listener.start()
+atexit.register(log_listener.stop)
+# QueueHandler.prepare() bakes its own formatting into the record, so it must
+# pass the bare message through for the listener's handlers to format once
+queue_handler = QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter('%(message)s'))
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.FileHandler("chapter_writer.log"), logging.StreamHandler()]
+    handlers=[queue_handler]
 )
 logger = logging.getLogger("chapter_writer")
 
+# Bounds on max_tokens for chapter requests; the upper bound is the model's
+# output limit and applies to single and batched requests alike
+MIN_CHAPTER_TOKENS = 4000
+MAX_OUTPUT_TOKENS = 64000
+# Output limit of the default draft model
+DRAFT_MAX_TOKENS = 8192
+
+# Output tokens budgeted per outline token
+OUTPUT_TOKENS_PER_OUTLINE_TOKEN = 20
+
+# Timestamp format used in chapter branch names
+BRANCH_TIME_FORMAT = '%Y%m%d-%H%M%S'
+
+# Characters of the outline quoted in a chapter PR description
+OUTLINE_PREVIEW_CHARS = 500
+
+# Delimiters used to split a batched multi-chapter response
+CHAPTER_TAG_RE = re.compile(r'<chapter id="(\d+)">(.*?)</chapter>', re.S)
+
+# A streamed chapter must contain \chapter{...} within this many characters
+STREAM_CHECK_CHARS = 4000
+STREAM_LOG_CHARS = 20000
+CHAPTER_START_RE = re.compile(r"\\chapter\*?\{")
+
+# Single-pass scanner for the structural LaTeX commands in a generated chapter
+LATEX_SCAN_RE = re.compile(
+    r"(?P<chapter>\\chapter\*?\{[^}]*\})"
+    r"|(?P<section>\\section\*?\{(?P<section_title>[^}]*)\})"
+    r"|(?P<env>\\begin\{(?:theorem|definition|example|proof)\})"
+)
+
+# Splits a drafted chapter before each \section for per-section refinement
+SECTION_SPLIT_RE = re.compile(r"(?=^\\section\*?\{)", re.MULTILINE)
+
+SYSTEM_PROMPT = "You are an expert mathematics professor writing a textbook chapter. Write in the style of Rudin/Atiyah Macdonald, balancing brevity with pedagogical clarity."
+
+def load_json_file(path):
+    """Parse a JSON file, using orjson when it is installed"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    return orjson.loads(data) if orjson else json.loads(data)
+
+def read_text_file(path):
+    """Read a UTF-8 text file through a memory map, decoding it in one step"""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ""
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return str(mapped, "utf-8")
+
+def read_stream_text(stream, chunk_size=65536):
+    """Read a binary stream to EOF in chunks, decoding UTF-8 as it arrives"""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    parts = []
+    while True:
+        data = stream.read1(chunk_size)
+        if not data:
+            break
+        parts.append(decoder.decode(data))
+    parts.append(decoder.decode(b"", final=True))
+    return "".join(parts)
+
+class RateLimiter:
+    """Token-bucket limiter for async API calls"""
+    
+    def __init__(self, requests_per_minute):
+        """
+        Initialize the rate limiter
+        
+        Args:
+            requests_per_minute (float): Sustained request rate to allow
+        """
+        self.rate = requests_per_minute / 60.0
+        self.capacity = max(1.0, float(requests_per_minute))
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = asyncio.Lock()
+    
+    async def acquire(self):
+        """Wait until a request token is available"""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class _DiskCache:
+    """On-disk cache of generated responses, keyed by a SHA-256 of the request"""
+    
+    def __init__(self, cache_dir):
+        """
+        Initialize the cache
+        
+        Args:
+            cache_dir (str): Root directory for cached responses
+        """
+        self.cache_dir = os.path.expanduser(cache_dir)
+    
+    @staticmethod
+    def make_key(params):
+        """Hash the request parameters that determine the response"""
+        payload = json.dumps(
+            {key: params[key] for key in ("model", "system", "messages", "max_tokens", "temperature")},
+            sort_keys=True
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    
+    def _path(self, key):
+        """Get the file path for a cache key"""
+        return os.path.join(self.cache_dir, key[:2], f"{key}.txt.gz")
+    
+    def get(self, key):
+        """Return the cached response for key, or None on a miss"""
+        try:
+            with gzip.open(self._path(key), 'rt', encoding="utf-8") as f:
+                return f.read()
+        except (OSError, EOFError):
+            return None
+    
+    def set(self, key, value):
+        """Store a response under key"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        
+        # Write to a temporary file first so a crash never leaves a partial entry
+        tmp_path = f"{path}.tmp"
+        with gzip.open(tmp_path, 'wt', encoding="utf-8") as f:
+            f.write(value)
+        os.replace(tmp_path, path)
+
+class _StreamScanner:
+    """Incremental sanity check of streamed chapter LaTeX"""
+    
+    def __init__(self, check_after=STREAM_CHECK_CHARS, log_every=STREAM_LOG_CHARS):
+        """
+        Initialize the scanner
+        
+        Args:
+            check_after (int): Characters to receive before requiring a \\chapter command
+            log_every (int): Log progress every this many characters
+        """
+        self.check_after = check_after
+        self.log_every = log_every
+        self.head = ""
+        self.length = 0
+        self.found_chapter = False
+        self.next_log = log_every
+    
+    def feed(self, text):
+        """
+        Consume the next chunk of streamed text
+        
+        Raises:
+            ValueError: If no \\chapter command appears within the first check_after characters
+        """
+        self.length += len(text)
+        
+        if not self.found_chapter:
+            self.head += text
+            if CHAPTER_START_RE.search(self.head):
+                self.found_chapter = True
+                self.head = ""
+            elif self.length >= self.check_after:
+                raise ValueError(
+                    f"No \\chapter command in the first {self.length} characters of the response; aborting"
+                )
+        
+        if self.length >= self.next_log:
+            logger.info(f"Received {self.length} characters")
+            self.next_log += self.log_every
+
 class ChapterWriterAgent:
     """Agent for generating mathematical book chapters"""
     
-    def __init__(self, repo_owner, repo_name, config_path="config.json"):
+    def __init__(self, repo_owner, repo_name, config_path="config.json", use_cache=True):
         """
         Initialize the chapter writer agent
         
@@ -43,29 +248,51 @@ class ChapterWriterAgent:
             repo_owner (str): Owner of the GitHub repository
             repo_name (str): Name of the GitHub repository
             config_path (str): Path to configuration file
+            use_cache (bool): Whether to reuse cached responses for identical requests
         """
         # Load configuration
         self.load_config(config_path)
         
-        # Initialize GitHub agent
+        # Heavy dependencies are imported here so `--help` stays fast
+        import anthropic
+        import requests
+        from requests.adapters import HTTPAdapter
+        from github_agent import GitHubAgent
+        
+        # Initialize GitHub agent with a pooled session shared by all threads
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=10)
+        session.mount("https://", adapter)
         self.github = GitHubAgent(
             repo_owner=repo_owner,
             repo_name=repo_name,
-            agent_name=self.config.get("agent_name", "ChapterWriterAgent")
+            agent_name=self.config.get("agent_name", "ChapterWriterAgent"),
+            session=session
         )
         
         # Initialize Claude client
         self.client = anthropic.Anthropic(
             api_key=os.getenv("ANTHROPIC_API_KEY")
         )
+        self.async_client = anthropic.AsyncAnthropic(
+            api_key=os.getenv("ANTHROPIC_API_KEY")
+        )
+        
+        # Cache of generated chapters for identical requests
+        self.cache_dir = os.path.expanduser(self.config.get("cache_dir", "~/.agitnt_cache"))
+        self.cache = _DiskCache(self.cache_dir) if use_cache else None
+        
+        # Template and style guide are fetched at most once per agent
+        self._template_cache = None
+        self._style_cache = None
+        self._system_blocks = None
         
         logger.info(f"Initialized ChapterWriterAgent for {repo_owner}/{repo_name}")
     
     def load_config(self, config_path):
         """Load configuration from JSON file"""
         try:
-            with open(config_path, 'r') as f:
-                self.config = json.load(f)
+            self.config = load_json_file(config_path)
             logger.info(f"Loaded configuration from {config_path}")
         except FileNotFoundError:
             logger.warning(f"Configuration file {config_path} not found. Using defaults.")
@@ -73,15 +300,61 @@ class ChapterWriterAgent:
                 "agent_name": "ChapterWriterAgent",
                 "model": "claude-3-7-sonnet-20250219",
                 "style_guide": "math_style_guide.md",
-                "template_path": "templates/chapter_template.tex"
+                "template_path": "templates/chapter_template.tex",
+                "two_stage": False,
+                "draft_model": "claude-3-5-haiku-20241022",
+                "final_model": "claude-3-7-sonnet-20250219"
             }
     
+    def _get_repo_file_cached(self, file_path):
+        """
+        Get a file from the repository, reusing a local copy from a previous run
+        
+        The local copy is reused only if its recorded blob SHA still matches
+        the repository, so the content is downloaded only when it changes.
+        
+        Args:
+            file_path (str): Path to the file in the repository
+            
+        Returns:
+            str: File content, or None if it isn't in the repository
+        """
+        sha = self.github.get_file_sha(file_path)
+        if not sha:
+            return None
+        
+        local_path = os.path.join(self.cache_dir, "files", file_path)
+        sha_path = f"{local_path}.sha"
+        try:
+            with open(sha_path, 'r') as f:
+                if f.read().strip() == sha:
+                    with open(local_path, 'r') as cached:
+                        logger.info(f"Using cached copy of {file_path}")
+                        return cached.read()
+        except FileNotFoundError:
+            pass
+        
+        content = self.github.get_file_content(file_path)
+        if content:
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            with open(local_path, 'w') as f:
+                f.write(content)
+            with open(sha_path, 'w') as f:
+                f.write(sha)
+        return content
+    
     def _get_chapter_template(self):
         """Get the chapter template from the repository or local file"""
+        if self._template_cache is None:
+            self._template_cache = self._load_chapter_template()
+        return self._template_cache
+    
+    def _load_chapter_template(self):
+        """Load the chapter template from the repository or local file"""
         template_path = self.config.get("template_path", "templates/chapter_template.tex")
         
         # Try to get from GitHub first
-        content = self.github.get_file_content(template_path)
+        content = self._get_repo_file_cached(template_path)
         if content:
             return content
         
@@ -107,10 +380,16 @@ $CHAPTER_EXERCISES
     
     def _get_style_guide(self):
         """Get the writing style guide"""
+        if self._style_cache is None:
+            self._style_cache = self._load_style_guide()
+        return self._style_cache
+    
+    def _load_style_guide(self):
+        """Load the writing style guide from the repository or the default"""
         style_path = self.config.get("style_guide", "math_style_guide.md")
         
         # Try to get from GitHub first
-        content = self.github.get_file_content(style_path)
+        content = self._get_repo_file_cached(style_path)
         if content:
             return content
         
@@ -146,62 +425,198 @@ $CHAPTER_EXERCISES
 - Include diagrams where helpful
 """
     
-    def generate_chapter_content(self, chapter_number, chapter_title, outline):
+    def _get_prompt_files(self):
         """
-        Generate chapter content using Claude
+        Get the chapter template and style guide, fetching them in parallel
+        
+        Returns:
+            tuple: (template, style_guide)
+        """
+        if self._template_cache is not None and self._style_cache is not None:
+            return self._template_cache, self._style_cache
+        
+        # The two lookups are independent GitHub round-trips
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            template_future = executor.submit(self._get_chapter_template)
+            style_future = executor.submit(self._get_style_guide)
+            return template_future.result(), style_future.result()
+    
+    def _build_system_blocks(self, template, style_guide):
+        """
+        Build the system prompt blocks shared by every chapter request
+        
+        Everything here is identical across chapters, so it goes first and is
+        marked for prompt caching; chapter-specific content is sent separately
+        in the user message.
         
         Args:
-            chapter_number (int): Chapter number
-            chapter_title (str): Chapter title
-            outline (str): Chapter outline or detailed description
+            template (str): Chapter template
+            style_guide (str): Writing style guide
             
         Returns:
-            str: LaTeX content for the chapter
+            list: System content blocks for messages.create
         """
-        # Get template and style guide
-        template = self._get_chapter_template()
-        style_guide = self._get_style_guide()
-        
-        # Construct prompt for Claude
-        prompt = f"""
-You are writing Chapter {chapter_number}: {chapter_title} for a mathematics textbook.
-
-# Chapter Outline/Specification:
-{outline}
-
+        return [
+            {"type": "text", "text": SYSTEM_PROMPT},
+            {
+                "type": "text",
+                "text": f"""
 # Writing Style:
 {style_guide}
 
+# Chapter Template:
+{template}
+
 # Task:
-Write this chapter in LaTeX format, following the outline provided and adhering to the writing style guide.
+Write the requested chapter in LaTeX format, following the outline provided and adhering to the writing style guide.
 The chapter should be comprehensive and mathematically rigorous, but also pedagogically sound.
 
 Important LaTeX guidelines:
-1. Use \theorem, \definition, \example, and \proof environments
-2. Number equations with \begin{{equation}} ... \end{{equation}}
+1. Use \\theorem, \\definition, \\example, and \\proof environments
+2. Number equations with \\begin{{equation}} ... \\end{{equation}}
 3. Include diagrams with TikZ where appropriate
-4. Structure sections logically with \section and \subsection
+4. Structure sections logically with \\section and \\subsection
 5. Include exercises at the end of the chapter
 
 Make sure all mathematics is correct and notation is consistent.
+""",
+                "cache_control": {"type": "ephemeral"}
+            }
+        ]
+    
+    def _get_system_blocks(self):
+        """
+        Get the system prompt blocks, building them on first use
+        
+        Building the prefix once keeps it byte-for-byte identical across
+        requests, which prompt cache hits depend on.
+        
+        Returns:
+            list: System content blocks for messages.create
+        """
+        if self._system_blocks is None:
+            template, style_guide = self._get_prompt_files()
+            self._system_blocks = self._build_system_blocks(template, style_guide)
+        return self._system_blocks
+    
+    def _estimate_max_tokens(self, outline, chapter_number=None):
+        """
+        Estimate an output token budget for a chapter from its outline
+        
+        Uses a cheap ~3 characters per token estimate rather than a
+        token-counting request. A per-chapter value in "chapter_max_tokens"
+        or a global "max_tokens" in the config overrides the estimate; either way
+        the result is clamped to the model's output limit.
+        
+        Args:
+            outline (str): Chapter outline
+            chapter_number (int, optional): Chapter number for per-chapter overrides
+            
+        Returns:
+            int: max_tokens for the request
+        """
+        overrides = self.config.get("chapter_max_tokens", {})
+        if chapter_number is not None and str(chapter_number) in overrides:
+            max_tokens = int(overrides[str(chapter_number)])
+        elif "max_tokens" in self.config:
+            max_tokens = int(self.config["max_tokens"])
+        else:
+            outline_tokens = len(outline) // 3
+            max_tokens = MIN_CHAPTER_TOKENS + OUTPUT_TOKENS_PER_OUTLINE_TOKEN * outline_tokens
+        
+        # The API refuses requests above the model's output limit
+        return min(max_tokens, MAX_OUTPUT_TOKENS)
+    
+    def _build_chapter_request(self, chapter_number, chapter_title, outline):
+        """
+        Build the messages.create parameters for a single chapter
+        
+        Args:
+            chapter_number (int): Chapter number
+            chapter_title (str): Chapter title
+            outline (str): Chapter outline or detailed description
+            
+        Returns:
+            dict: Request parameters
+        """
+        # Stable prefix first (cached), chapter-specific content last
+        system = self._get_system_blocks()
+        prompt = f"""
+You are writing Chapter {chapter_number}: {chapter_title} for a mathematics textbook.
+
+# Chapter Outline/Specification:
+{outline}
 """
         
+        return {
+            "model": self.config.get("model", "claude-3-7-sonnet-20250219"),
+            "max_tokens": self._estimate_max_tokens(outline, chapter_number),
+            "temperature": 0.3,
+            "system": system,
+            "messages": [{"role": "user", "content": prompt}]
+        }
+    
+    def _cache_lookup(self, params):
+        """
+        Look up a cached response for the request parameters
+        
+        Responses are only cached for deterministic requests (temperature 0)
+        unless "cache_sampled_responses" is enabled in the config.
+        
+        Args:
+            params (dict): Request parameters
+            
+        Returns:
+            tuple: (cache key or None if caching is disabled, cached content or None)
+        """
+        if not self.cache:
+            return None, None
+        
+        if params["temperature"] != 0:
+            if not self.config.get("cache_sampled_responses", False):
+                return None, None
+            logger.warning(
+                f"Caching a response sampled at temperature {params['temperature']}; "
+                f"use --no-cache to force regeneration"
+            )
+        
+        key = self.cache.make_key(params)
+        content = self.cache.get(key)
+        if content is not None:
+            logger.info(f"Using cached response {key[:12]}")
+        return key, content
+    
+    def generate_chapter_content(self, chapter_number, chapter_title, outline):
+        """
+        Generate chapter content using Claude
+        
+        Args:
+            chapter_number (int): Chapter number
+            chapter_title (str): Chapter title
+            outline (str): Chapter outline or detailed description
+            
+        Returns:
+            str: LaTeX content for the chapter
+        """
+        if self.config.get("two_stage", False):
+            return self.generate_chapter_two_stage(chapter_number, chapter_title, outline)
+        
         # Generate content using Claude
+        params = self._build_chapter_request(chapter_number, chapter_title, outline)
+        cache_key, content = self._cache_lookup(params)
+        if content is not None:
+            return content
+        
         logger.info(f"Generating content for Chapter {chapter_number}: {chapter_title}")
         try:
-            response = self.client.messages.create(
-                model=self.config.get("model", "claude-3-7-sonnet-20250219"),
-                max_tokens=100000,
-                temperature=0.3,
-                system="You are an expert mathematics professor writing a textbook chapter. Write in the style of Rudin/Atiyah Macdonald, balancing brevity with pedagogical clarity.",
-                messages=[{"role": "user", "content": prompt}]
-            )
+            # Stream the response so malformed output can be aborted early
+            content = self._stream_text(params, _StreamScanner())
+            if cache_key:
+                self.cache.set(cache_key, content)
             
-            # Extract content from response
-            content = response.content[0].text
-            
-            # Process the content to fit the template if needed
-            # (You might need to parse sections, introduction, etc.)
+            # Check the chapter structure in a single pass over the content
+            # (further template processing can dispatch from the same scan)
+            self._scan_latex_structure(content)
             
             # For now, we'll just use the raw content from Claude
             return content
@@ -210,20 +625,292 @@ Make sure all mathematics is correct and notation is consistent.
             logger.error(f"Error generating chapter content: {str(e)}")
             raise
     
-    def process_chapter(self, chapter_number, chapter_title, outline_path=None, outline_text=None):
+    def _stream_text(self, params, scanner=None):
         """
-        Process a chapter from outline to GitHub pull request
+        Stream a Claude response and return its text
+        
+        Args:
+            params (dict): Request parameters
+            scanner (_StreamScanner, optional): Checks the text as it arrives
+            
+        Returns:
+            str: Response text
+        """
+        chunks = []
+        with self.client.messages.stream(**params) as stream:
+            for text in stream.text_stream:
+                chunks.append(text)
+                if scanner:
+                    scanner.feed(text)
+            response = stream.get_final_message()
+        self._log_cache_usage(response)
+        return "".join(chunks)
+    
+    def _draft_sections(self, chapter_number, chapter_title, outline):
+        """
+        Draft a chapter with the cheaper draft model and split it into sections
+        
+        Drafts are stored in the response cache so re-running the refinement
+        step doesn't re-draft.
         
         Args:
             chapter_number (int): Chapter number
             chapter_title (str): Chapter title
+            outline (str): Chapter outline or detailed description
+            
+        Returns:
+            list: Drafted LaTeX, split before each \\section (the first item is
+                the chapter heading and introduction)
+        """
+        params = self._build_chapter_request(chapter_number, chapter_title, outline)
+        params["model"] = self.config.get("draft_model", "claude-3-5-haiku-20241022")
+        # The draft model has a much smaller output limit than the final model
+        params["max_tokens"] = min(
+            params["max_tokens"], int(self.config.get("draft_max_tokens", DRAFT_MAX_TOKENS))
+        )
+        
+        cache_key, draft = self._cache_lookup(params)
+        if draft is None:
+            logger.info(f"Drafting Chapter {chapter_number} with {params['model']}")
+            draft = self._stream_text(params, _StreamScanner())
+            if cache_key:
+                self.cache.set(cache_key, draft)
+        
+        return [section for section in SECTION_SPLIT_RE.split(draft) if section.strip()]
+    
+    def _refine_section(self, chapter_number, chapter_title, outline, section):
+        """
+        Rewrite one drafted section with the final model
+        
+        Args:
+            chapter_number (int): Chapter number
+            chapter_title (str): Chapter title
+            outline (str): Chapter outline, for context
+            section (str): Drafted LaTeX for the section
+            
+        Returns:
+            str: Refined LaTeX for the section
+        """
+        prompt = f"""
+You are revising a draft section of Chapter {chapter_number}: {chapter_title} for a mathematics textbook.
+
+# Chapter Outline/Specification:
+{outline}
+
+# Draft Section:
+{section}
+
+Rewrite this section so it meets the style guide and is mathematically correct and complete.
+Output only the revised LaTeX for this section.
+"""
+        params = {
+            "model": self.config.get("final_model", self.config.get("model", "claude-3-7-sonnet-20250219")),
+            "max_tokens": min(MAX_OUTPUT_TOKENS, MIN_CHAPTER_TOKENS + 2 * len(section) // 3),
+            "temperature": 0.3,
+            "system": self._get_system_blocks(),
+            "messages": [{"role": "user", "content": prompt}]
+        }
+        
+        cache_key, refined = self._cache_lookup(params)
+        if refined is None:
+            refined = self._stream_text(params)
+            if cache_key:
+                self.cache.set(cache_key, refined)
+        return refined
+    
+    def generate_chapter_two_stage(self, chapter_number, chapter_title, outline):
+        """
+        Generate a chapter by drafting with a cheap model and refining with the final model
+        
+        Only sections of at least "refine_min_chars" characters are sent to
+        the final model; they are refined in parallel.
+        
+        Args:
+            chapter_number (int): Chapter number
+            chapter_title (str): Chapter title
+            outline (str): Chapter outline or detailed description
+            
+        Returns:
+            str: LaTeX content for the chapter
+        """
+        try:
+            sections = self._draft_sections(chapter_number, chapter_title, outline)
+            min_chars = self.config.get("refine_min_chars", 500)
+            
+            logger.info(f"Refining {len(sections)} drafted sections of Chapter {chapter_number}")
+            with ThreadPoolExecutor(max_workers=self.config.get("max_concurrent", 8)) as executor:
+                futures = [
+                    executor.submit(self._refine_section, chapter_number, chapter_title, outline, section)
+                    if len(section) >= min_chars else None
+                    for section in sections
+                ]
+                refined = [
+                    future.result() if future else section
+                    for future, section in zip(futures, sections)
+                ]
+            
+            content = "\n\n".join(section.strip() for section in refined)
+            self._scan_latex_structure(content)
+            return content
+            
+        except Exception as e:
+            logger.error(f"Error generating chapter content: {str(e)}")
+            raise
+    
+    def _scan_latex_structure(self, content):
+        """
+        Scan generated LaTeX once and summarize its structure
+        
+        Args:
+            content (str): Generated LaTeX content
+            
+        Returns:
+            dict: Counts of chapters, sections, and theorem-like environments
+        """
+        counts = {"chapter": 0, "section": 0, "env": 0}
+        has_exercises = False
+        for match in LATEX_SCAN_RE.finditer(content):
+            kind = match.lastgroup
+            counts[kind] += 1
+            if kind == "section" and match.group("section_title").strip() == "Exercises":
+                has_exercises = True
+        
+        if not counts["chapter"]:
+            logger.warning("Generated content has no \\chapter command")
+        if not has_exercises:
+            logger.warning("Generated content has no Exercises section")
+        logger.info(
+            f"Generated {counts['section']} sections and {counts['env']} "
+            f"theorem/definition/example/proof environments"
+        )
+        return counts
+    
+    def _log_cache_usage(self, response):
+        """Log prompt cache statistics reported by the API"""
+        usage = getattr(response, "usage", None)
+        if not usage:
+            return
+        
+        cache_read = getattr(usage, "cache_read_input_tokens", 0) or 0
+        cache_write = getattr(usage, "cache_creation_input_tokens", 0) or 0
+        uncached = getattr(usage, "input_tokens", 0) or 0
+        total = cache_read + cache_write + uncached
+        
+        if total:
+            logger.info(
+                f"Prompt cache: {cache_read} read, {cache_write} written, {uncached} uncached "
+                f"input tokens ({100 * cache_read / total:.1f}% hit rate)"
+            )
+    
+    def _group_batch_specs(self, specs):
+        """
+        Group chapter specs so each group's output budget fits one request
+        
+        Args:
+            specs (list): List of (chapter_number, chapter_title, outline) tuples
+            
+        Returns:
+            list: Groups of specs, each with a summed token estimate of at
+                most MAX_OUTPUT_TOKENS
+        """
+        groups = []
+        current = []
+        current_tokens = 0
+        for spec in specs:
+            tokens = self._estimate_max_tokens(spec[2], spec[0])
+            if current and current_tokens + tokens > MAX_OUTPUT_TOKENS:
+                groups.append(current)
+                current = []
+                current_tokens = 0
+            current.append(spec)
+            current_tokens += tokens
+        if current:
+            groups.append(current)
+        return groups
+    
+    def generate_chapters_batched(self, specs):
+        """
+        Generate several chapters with as few Claude requests as fit the output limit
+        
+        Args:
+            specs (list): List of (chapter_number, chapter_title, outline) tuples
+            
+        Returns:
+            dict: Mapping of chapter number to LaTeX content; chapters whose
+                batch failed or could not be split are left out
+        """
+        chapters = {}
+        for group in self._group_batch_specs(specs):
+            try:
+                chapters.update(self._generate_batch(group))
+            except Exception as e:
+                logger.warning(f"Batched generation failed for Chapters {[spec[0] for spec in group]}: {str(e)}")
+        return chapters
+    
+    def _generate_batch(self, specs):
+        """
+        Generate a group of chapters with a single streamed Claude request
+        
+        Args:
+            specs (list): List of (chapter_number, chapter_title, outline) tuples
+            
+        Returns:
+            dict: Mapping of chapter number to LaTeX content for the chapters
+                found in the response
+        """
+        # Same cached prefix as the single-chapter path, batched chapter list last
+        system = self._get_system_blocks()
+        chapter_list = "\n\n".join(
+            f"{chapter_number}. Chapter {chapter_number}: {chapter_title}\n"
+            f"# Chapter Outline/Specification:\n{outline}"
+            for chapter_number, chapter_title, outline in specs
+        )
+        prompt = f"""
+You must write {len(specs)} chapters for a mathematics textbook.
+Emit each chapter between <chapter id="k">...</chapter> tags, where k is the chapter number.
+
+{chapter_list}
+"""
+        
+        # Generate content using Claude; responses this long must be streamed
+        chapter_numbers = [spec[0] for spec in specs]
+        logger.info(f"Generating batched content for Chapters {chapter_numbers}")
+        params = {
+            "model": self.config.get("model", "claude-3-7-sonnet-20250219"),
+            "max_tokens": min(
+                sum(self._estimate_max_tokens(outline, chapter_number) for chapter_number, _, outline in specs),
+                MAX_OUTPUT_TOKENS
+            ),
+            "temperature": 0.3,
+            "system": system,
+            "messages": [{"role": "user", "content": prompt}]
+        }
+        text = self._stream_text(params)
+        
+        # Split the response into individual chapters
+        chapters = {
+            int(chapter_id): content.strip()
+            for chapter_id, content in CHAPTER_TAG_RE.findall(text)
+            if int(chapter_id) in chapter_numbers
+        }
+        
+        missing = [n for n in chapter_numbers if n not in chapters]
+        if missing:
+            logger.warning(f"Batched response is missing Chapters {missing}")
+        
+        return chapters
+    
+    def _read_outline(self, outline_path=None, outline_text=None):
+        """
+        Read a chapter outline from text, the repository, or a local file
+        
+        Args:
             outline_path (str, optional): Path to outline file
             outline_text (str, optional): Direct outline text
             
         Returns:
-            dict: Pull request information
+            str: Outline text, or None if it could not be read
         """
-        # Get the outline
         outline = outline_text
         if outline_path and not outline:
             try:
@@ -232,8 +919,7 @@ Make sure all mathematics is correct and notation is consistent.
                 
                 # If not in repo, try local file
                 if not outline:
-                    with open(outline_path, 'r') as f:
-                        outline = f.read()
+                    outline = read_text_file(outline_path)
             except Exception as e:
                 logger.error(f"Failed to read outline: {str(e)}")
                 return None
@@ -242,21 +928,49 @@ Make sure all mathematics is correct and notation is consistent.
             logger.error("No outline provided")
             return None
         
-        # Create a branch for this chapter
-        branch_name = f"chapter-{chapter_number}-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+        return outline
+    
+    def _create_chapter_branch(self, chapter_number, branch_suffix=None):
+        """
+        Create the branch a chapter is committed to
+        
+        Args:
+            chapter_number (int): Chapter number
+            branch_suffix (str, optional): Branch name suffix; defaults to the current time.
+                Runs that create many branches pass a shared timestamp plus an index.
+            
+        Returns:
+            str: Name of the branch
+        """
+        if branch_suffix is None:
+            branch_suffix = datetime.now().strftime(BRANCH_TIME_FORMAT)
+        branch_name = f"chapter-{chapter_number}-{branch_suffix}"
         self.github.create_branch(branch_name)
         logger.info(f"Created branch: {branch_name}")
+        return branch_name
+    
+    def _submit_chapter(self, chapter_number, chapter_title, outline_preview, chapter_content, branch_name):
+        """
+        Commit generated chapter content to a branch and open a pull request
         
-        # Generate chapter content
-        chapter_content = self.generate_chapter_content(chapter_number, chapter_title, outline)
-        
-        # Save to GitHub
+        Args:
+            chapter_number (int): Chapter number
+            chapter_title (str): Chapter title
+            outline_preview (str): Start of the chapter outline (used for the PR description)
+            chapter_content (str): Generated LaTeX content
+            branch_name (str): Branch to commit to
+            
+        Returns:
+            dict: Pull request information
+        """
+        # Save to GitHub, encoding the content once for the contents API
         file_path = f"chapters/chapter{chapter_number}.tex"
         self.github.create_or_update_file(
             file_path=file_path,
-            content=chapter_content,
+            content=None,
             commit_message=f"Add Chapter {chapter_number}: {chapter_title}",
-            branch=branch_name
+            branch=branch_name,
+            content_b64=base64.b64encode(chapter_content.encode("utf-8")).decode("ascii")
         )
         logger.info(f"Committed chapter to {branch_name}")
         
@@ -270,7 +984,7 @@ This PR contains the generated content for Chapter {chapter_number}.
 
 ## Outline
 ```
-{outline[:500]}... 
+{outline_preview}... 
 ```
 *(outline truncated for brevity)*
 
@@ -285,6 +999,319 @@ This PR contains the generated content for Chapter {chapter_number}.
         
         logger.info(f"Created PR #{pr['number']} for review")
         return pr
+    
+    def process_chapter(self, chapter_number, chapter_title, outline_path=None, outline_text=None):
+        """
+        Process a chapter from outline to GitHub pull request
+        
+        Args:
+            chapter_number (int): Chapter number
+            chapter_title (str): Chapter title
+            outline_path (str, optional): Path to outline file
+            outline_text (str, optional): Direct outline text
+            
+        Returns:
+            dict: Pull request information
+        """
+        # Get the outline
+        outline = self._read_outline(outline_path, outline_text)
+        if not outline:
+            return None
+        
+        # Create a branch for this chapter
+        branch_name = self._create_chapter_branch(chapter_number)
+        
+        # Generate chapter content
+        chapter_content = self.generate_chapter_content(chapter_number, chapter_title, outline)
+        
+        return self._submit_chapter(
+            chapter_number, chapter_title, outline[:OUTLINE_PREVIEW_CHARS], chapter_content, branch_name
+        )
+    
+    def _submit_chapters_together(self, specs, chapters):
+        """
+        Commit several generated chapters to one branch in a single commit and open one PR
+        
+        Args:
+            specs (list): List of (chapter_number, chapter_title, outline) tuples
+            chapters (dict): Mapping of chapter number to LaTeX content
+            
+        Returns:
+            dict: Pull request information
+        """
+        chapter_numbers = [str(spec[0]) for spec in specs]
+        branch_name = self._create_chapter_branch("-".join(chapter_numbers))
+        
+        files = {
+            f"chapters/chapter{chapter_number}.tex": chapters[chapter_number]
+            for chapter_number, _, _ in specs
+        }
+        self.github.commit_files(
+            branch=branch_name,
+            files=files,
+            message=f"Add Chapters {', '.join(chapter_numbers)}"
+        )
+        logger.info(f"Committed {len(files)} chapters to {branch_name}")
+        
+        chapter_list = "\n".join(
+            f"- Chapter {chapter_number}: {chapter_title}"
+            for chapter_number, chapter_title, _ in specs
+        )
+        pr = self.github.create_pull_request(
+            title=f"Chapters {', '.join(chapter_numbers)}",
+            body=f"""
+# Chapters {', '.join(chapter_numbers)}
+
+This PR contains the generated content for:
+{chapter_list}
+
+## Review Requested
+- Mathematical accuracy
+- Pedagogical clarity
+- LaTeX formatting and structure
+- Consistency with book style
+            """,
+            head_branch=branch_name
+        )
+        
+        logger.info(f"Created PR #{pr['number']} for review")
+        return pr
+    
+    def process_chapters(self, specs, single_branch=False):
+        """
+        Process several chapters with batched Claude requests
+        
+        By default each chapter gets its own branch and pull request. With
+        single_branch, all chapters are committed to one branch in a single
+        commit and share one pull request. Chapters missing from the batched
+        responses are generated individually.
+        
+        Args:
+            specs (list): List of (chapter_number, chapter_title, outline) tuples
+            single_branch (bool): Whether to put all chapters in one commit and PR
+            
+        Returns:
+            list: Pull request information for each chapter (or the single shared PR)
+        """
+        chapters = self.generate_chapters_batched(specs)
+        
+        # Generate anything the batches didn't return one chapter at a time
+        for chapter_number, chapter_title, outline in specs:
+            if chapter_number not in chapters:
+                logger.info(f"Falling back to single-chapter generation for Chapter {chapter_number}")
+                chapters[chapter_number] = self.generate_chapter_content(chapter_number, chapter_title, outline)
+        
+        if single_branch:
+            return [self._submit_chapters_together(specs, chapters)]
+        
+        results = []
+        timestamp = datetime.now().strftime(BRANCH_TIME_FORMAT)
+        for index, (chapter_number, chapter_title, outline) in enumerate(specs):
+            # Create a branch for this chapter
+            branch_name = self._create_chapter_branch(chapter_number, f"{timestamp}-{index}")
+            
+            results.append(self._submit_chapter(
+                chapter_number, chapter_title, outline[:OUTLINE_PREVIEW_CHARS], chapters[chapter_number], branch_name
+            ))
+        
+        return results
+    
+    async def generate_chapter_content_async(self, chapter_number, chapter_title, outline):
+        """
+        Generate chapter content using the async Claude client
+        
+        Args:
+            chapter_number (int): Chapter number
+            chapter_title (str): Chapter title
+            outline (str): Chapter outline or detailed description
+            
+        Returns:
+            str: LaTeX content for the chapter
+        """
+        if self.config.get("two_stage", False):
+            return await asyncio.to_thread(self.generate_chapter_two_stage, chapter_number, chapter_title, outline)
+        
+        # Template and style guide lookups are blocking GitHub calls
+        params = await asyncio.to_thread(self._build_chapter_request, chapter_number, chapter_title, outline)
+        cache_key, content = await asyncio.to_thread(self._cache_lookup, params)
+        if content is not None:
+            return content
+        
+        logger.info(f"Generating content for Chapter {chapter_number}: {chapter_title}")
+        try:
+            # Stream the response so malformed output can be aborted early
+            chunks = []
+            scanner = _StreamScanner()
+            async with self.async_client.messages.stream(**params) as stream:
+                async for text in stream.text_stream:
+                    chunks.append(text)
+                    scanner.feed(text)
+                response = await stream.get_final_message()
+            self._log_cache_usage(response)
+            
+            content = "".join(chunks)
+            if cache_key:
+                await asyncio.to_thread(self.cache.set, cache_key, content)
+            
+            self._scan_latex_structure(content)
+            return content
+            
+        except Exception as e:
+            logger.error(f"Error generating chapter content: {str(e)}")
+            raise
+    
+    async def process_chapter_async(self, chapter_number, chapter_title, outline_path=None, outline_text=None,
+                                    branch_suffix=None):
+        """
+        Process a chapter from outline to GitHub pull request without blocking
+        
+        GitHub calls run in worker threads so several chapters can overlap
+        their Claude and GitHub latency.
+        
+        Args:
+            chapter_number (int): Chapter number
+            chapter_title (str): Chapter title
+            outline_path (str, optional): Path to outline file
+            outline_text (str, optional): Direct outline text
+            branch_suffix (str, optional): Branch name suffix; defaults to the current time
+            
+        Returns:
+            dict: Pull request information
+        """
+        # Get the outline
+        outline = await asyncio.to_thread(self._read_outline, outline_path, outline_text)
+        if not outline:
+            return None
+        
+        # Create a branch for this chapter
+        branch_name = await asyncio.to_thread(self._create_chapter_branch, chapter_number, branch_suffix)
+        
+        # Generate chapter content
+        chapter_content = await self.generate_chapter_content_async(chapter_number, chapter_title, outline)
+        
+        return await asyncio.to_thread(
+            self._submit_chapter,
+            chapter_number, chapter_title, outline[:OUTLINE_PREVIEW_CHARS], chapter_content, branch_name
+        )
+    
+    async def run_many(self, specs):
+        """
+        Process several chapters concurrently
+        
+        Concurrency is capped by the "max_concurrent" config value and
+        Claude requests are throttled to "requests_per_minute".
+        
+        Args:
+            specs (list): List of (chapter_number, chapter_title, outline) tuples
+            
+        Returns:
+            list: Pull request information (or the raised exception) for each chapter
+        """
+        semaphore = asyncio.Semaphore(self.config.get("max_concurrent", 8))
+        limiter = RateLimiter(self.config.get("requests_per_minute", 50))
+        
+        timestamp = datetime.now().strftime(BRANCH_TIME_FORMAT)
+        
+        async def run_one(index, spec):
+            chapter_number, chapter_title, outline = spec
+            async with semaphore:
+                await limiter.acquire()
+                return await self.process_chapter_async(
+                    chapter_number, chapter_title, outline_text=outline, branch_suffix=f"{timestamp}-{index}"
+                )
+        
+        return await asyncio.gather(*(run_one(index, spec) for index, spec in enumerate(specs)), return_exceptions=True)
+    
+    def submit_chapter_batch(self, specs):
+        """
+        Submit chapters to the Message Batches API for offline generation
+        
+        Batched requests are billed at a discount but may take up to 24 hours
+        to complete. The batch ID and specs are saved to disk so the results
+        can be collected later with poll_batch.
+        
+        Args:
+            specs (list): List of (chapter_number, chapter_title, outline) tuples
+            
+        Returns:
+            str: Batch ID
+        """
+        batch_requests = [
+            {
+                "custom_id": f"ch-{chapter_number}",
+                "params": self._build_chapter_request(chapter_number, chapter_title, outline)
+            }
+            for chapter_number, chapter_title, outline in specs
+        ]
+        
+        batch = self.client.messages.batches.create(requests=batch_requests)
+        logger.info(f"Submitted batch {batch.id} with {len(batch_requests)} chapters")
+        
+        # Save the batch so results can be collected by a later run. Only the
+        # outline preview is needed for the PR description from here on.
+        state_path = self.config.get("batch_state_path", "chapter_batch.json")
+        saved_specs = [
+            [chapter_number, chapter_title, outline[:OUTLINE_PREVIEW_CHARS]]
+            for chapter_number, chapter_title, outline in specs
+        ]
+        with open(state_path, 'w') as f:
+            json.dump({"batch_id": batch.id, "specs": saved_specs}, f, indent=2)
+        logger.info(f"Saved batch state to {state_path}")
+        
+        return batch.id
+    
+    def poll_batch(self, batch_id=None, poll_interval=30, max_interval=600):
+        """
+        Wait for a message batch to finish and open a PR for each chapter
+        
+        Args:
+            batch_id (str, optional): Batch ID; defaults to the last saved batch
+            poll_interval (int): Initial polling interval in seconds
+            max_interval (int): Maximum polling interval in seconds
+            
+        Returns:
+            list: Pull request information for each successful chapter
+        """
+        state_path = self.config.get("batch_state_path", "chapter_batch.json")
+        state = load_json_file(state_path)
+        
+        batch_id = batch_id or state["batch_id"]
+        specs = {f"ch-{spec[0]}": spec for spec in state["specs"]}
+        
+        # Poll with exponential backoff until processing has ended
+        interval = poll_interval
+        while True:
+            batch = self.client.messages.batches.retrieve(batch_id)
+            if batch.processing_status == "ended":
+                break
+            logger.info(f"Batch {batch_id} is {batch.processing_status}, checking again in {interval}s")
+            time.sleep(interval)
+            interval = min(interval * 2, max_interval)
+        
+        logger.info(f"Batch {batch_id} finished processing")
+        
+        # Route each completed chapter through the normal commit/PR pipeline
+        results = []
+        timestamp = datetime.now().strftime(BRANCH_TIME_FORMAT)
+        for index, entry in enumerate(self.client.messages.batches.results(batch_id)):
+            spec = specs.get(entry.custom_id)
+            if not spec:
+                logger.warning(f"Unknown result {entry.custom_id} in batch {batch_id}")
+                continue
+            
+            if entry.result.type != "succeeded":
+                logger.error(f"Batch request {entry.custom_id} {entry.result.type}")
+                continue
+            
+            chapter_number, chapter_title, outline_preview = spec
+            branch_name = self._create_chapter_branch(chapter_number, f"{timestamp}-{index}")
+            
+            chapter_content = entry.result.message.content[0].text
+            results.append(self._submit_chapter(
+                chapter_number, chapter_title, outline_preview, chapter_content, branch_name
+            ))
+        
+        return results
 
 
 def main():
@@ -292,25 +1319,57 @@ def main():
     parser = argparse.ArgumentParser(description="Generate a math textbook chapter and submit to GitHub")
     parser.add_argument("--repo-owner", required=True, help="GitHub repository owner")
     parser.add_argument("--repo-name", required=True, help="GitHub repository name")
-    parser.add_argument("--chapter", required=True, type=int, help="Chapter number")
-    parser.add_argument("--title", required=True, help="Chapter title")
+    parser.add_argument("--chapter", type=int, help="Chapter number")
+    parser.add_argument("--title", help="Chapter title")
     parser.add_argument("--outline", help="Path to outline file")
     parser.add_argument("--config", default="config.json", help="Path to configuration file")
+    parser.add_argument("--no-cache", action="store_true", help="Always regenerate instead of reusing cached responses")
+    parser.add_argument("--batch", metavar="SPECS_FILE",
+                        help="Submit the chapters listed in a JSON specs file via the Message Batches API")
+    parser.add_argument("--poll-batch", nargs="?", const="", metavar="BATCH_ID",
+                        help="Wait for a submitted batch (default: the last one) and create PRs for its chapters")
     
     args = parser.parse_args()
+    if args.batch is None and args.poll_batch is None and (args.chapter is None or not args.title):
+        parser.error("--chapter and --title are required unless --batch or --poll-batch is given")
     
     # Create the agent
     agent = ChapterWriterAgent(
         repo_owner=args.repo_owner,
         repo_name=args.repo_name,
-        config_path=args.config
+        config_path=args.config,
+        use_cache=not args.no_cache
     )
     
+    # Submit a batch of chapters for offline generation
+    if args.batch:
+        # Specs file: [{"chapter": 1, "title": "...", "outline": "path/to/outline.md"}, ...]
+        chapter_specs = load_json_file(args.batch)
+        
+        specs = []
+        for spec in chapter_specs:
+            outline = agent._read_outline(spec.get("outline"), spec.get("outline_text"))
+            if not outline:
+                print(f"Failed to read outline for Chapter {spec['chapter']}")
+                return 1
+            specs.append((spec["chapter"], spec["title"], outline))
+        
+        batch_id = agent.submit_chapter_batch(specs)
+        print(f"Submitted batch {batch_id}; collect results with --poll-batch {batch_id}")
+        return 0
+    
+    # Collect the results of a submitted batch
+    if args.poll_batch is not None:
+        results = agent.poll_batch(args.poll_batch or None)
+        for result in results:
+            print(f"Successfully created PR #{result['number']}: {result['html_url']}")
+        return 0 if results else 1
+    
     # Process the chapter
     outline_text = None
     if not args.outline:
         print("Enter chapter outline (end with Ctrl+D on Unix or Ctrl+Z on Windows):")
-        outline_text = sys.stdin.read()
+        outline_text = read_stream_text(sys.stdin.buffer)
     
     result = agent.process_chapter(
         chapter_number=args.chapter,
@@ -24,6 +24,10 @@ import subprocess
 import tempfile
 import shutil
 import re
+import glob
+import shlex
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from github_agent import GitHubAgent
 from datetime import datetime
@@ -55,7 +59,7 @@ class CompilerAgent:
         self.github = GitHubAgent(
             repo_owner=repo_owner,
             repo_name=repo_name,
-            agent_name=self.config.get("agent_name", "CompilerAgent")
+            agent_name=self.agent_name
         )
         
         # Working directory for compilation
@@ -75,27 +79,106 @@ class CompilerAgent:
                 "agent_name": "CompilerAgent",
                 "main_file": "main.tex",
                 "output_branch": "compiled-output",
-                "include_pattern": r"\\include{chapters/chapter(\d+)}",
+                "include_pattern": r"\\include\{([^}]+)\}",
+                "include_strip_pattern": r"\\include\{chapters/chapter\d+\}\s*",
                 "chapter_pattern": r"chapters/chapter(\d+)\.tex",
                 "build_command": "pdflatex -interaction=nonstopmode {main_file}",
                 "bibtex_command": "bibtex {main_name}",
                 "run_bibtex": True,
                 "latex_runs": 2
             }
+        
+        # Materialize settings once so the compile loop doesn't re-read the dict
+        self.agent_name = self.config.get("agent_name", "CompilerAgent")
+        self.main_file = self.config.get("main_file", "main.tex")
+        self.output_branch = self.config.get("output_branch", "compiled-output")
+        self.output_dir = self.config.get("output_dir", "compiled")
+        self.build_command_tmpl = self.config.get("build_command", "pdflatex -interaction=nonstopmode {main_file}")
+        self.bibtex_command_tmpl = self.config.get("bibtex_command", "bibtex {main_name}")
+        self.run_bibtex = bool(self.config.get("run_bibtex", True))
+        self.latex_runs = int(self.config.get("latex_runs", 2))
+        self.work_root = self.config.get("work_root")
+        self.max_download_workers = int(self.config.get("max_download_workers", 16))
+        self.pdf_cache_dir = os.path.expanduser(self.config.get("pdf_cache_dir", "~/.cache/agitnt/pdfs"))
+        
+        # Compile the configured patterns once instead of at every call site.
+        # Custom patterns should prefer negated classes like [^}]+ over .*?
+        # so they match in a single forward pass over main.tex.
+        self._re_include = re.compile(self.config.get("include_pattern", r"\\include\{([^}]+)\}"))
+        self._re_include_strip = re.compile(
+            self.config.get("include_strip_pattern", r"\\include\{chapters/chapter\d+\}\s*")
+        )
+        self._re_chapter_path = re.compile(self.config.get("chapter_pattern", r"chapters/chapter(\d+)\.tex"))
+        self._re_chapter_file = re.compile(r"chapter(\d+)\.tex")
+        self._re_doc = re.compile(
+            r"(?s)\A(?P<pre>.*?\\begin\{document\}[ \t]*\n?(?:.*?\\tableofcontents[^\n]*\n)?)"
+            r"(?P<body>.*?)(?P<post>\\end\{document\}.*)\Z"
+        )
     
     def setup_working_directory(self):
-        """Set up a temporary working directory for compilation"""
-        self.work_dir = tempfile.mkdtemp(prefix="mathbook_compiler_")
+        """
+        Set up a temporary working directory for compilation
+        
+        LaTeX does many small reads and writes of .aux/.toc/.log files, so the
+        directory goes on RAM-backed storage when available: the configured
+        work_root, else /dev/shm (tmpfs on Linux), else the system temp dir.
+        """
+        base = self.work_root or ("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir())
+        self.work_dir = tempfile.mkdtemp(prefix="mathbook_compiler_", dir=base)
         logger.info(f"Created working directory: {self.work_dir}")
         return self.work_dir
     
     def cleanup_working_directory(self):
         """Clean up the temporary working directory"""
         if self.work_dir and os.path.exists(self.work_dir):
-            shutil.rmtree(self.work_dir)
+            def log_error(func, path, exc_info):
+                logger.warning(f"Could not remove {path}: {exc_info[1]}")
+            
+            # Keep going past individual failures so RAM-backed space isn't leaked
+            shutil.rmtree(self.work_dir, onerror=log_error)
             self.work_dir = None
             logger.info("Cleaned up working directory")
     
+    def _write_file(self, file_path, content):
+        """
+        Write a downloaded file into the working directory
+        
+        Args:
+            file_path (str): Path relative to the repository root
+            content (str): File content
+        """
+        full_path = os.path.join(self.work_dir, file_path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'w') as f:
+            f.write(content)
+    
+    def _download_files(self, file_paths, branch="main"):
+        """
+        Download files concurrently, streaming each into the working directory
+        
+        Args:
+            file_paths (list): Repository paths to download
+            branch (str): Branch to download from
+            
+        Returns:
+            int: Number of files downloaded
+        """
+        def download(file_path):
+            full_path = os.path.join(self.work_dir, file_path)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            return file_path, self.github.download_file(file_path, full_path, branch)
+        
+        # Each download writes its own file, so they can all overlap
+        downloaded = 0
+        with ThreadPoolExecutor(max_workers=self.max_download_workers) as executor:
+            for file_path, found in executor.map(download, file_paths):
+                if not found:
+                    logger.warning(f"File {file_path} not found, skipping")
+                    continue
+                logger.info(f"Downloaded {file_path}")
+                downloaded += 1
+        return downloaded
+    
     def download_repository_files(self, branch="main"):
         """
         Download all necessary files from the repository to the working directory
@@ -110,28 +193,26 @@ class CompilerAgent:
             self.setup_working_directory()
         
         try:
+            # List every file in the branch once instead of probing paths
+            repo_paths = self.github.list_tree(branch)
+            available = set(repo_paths)
+            
             # Get the main tex file first
-            main_file_path = self.config.get("main_file", "main.tex")
+            main_file_path = self.main_file
             main_content = self.github.get_file_content(main_file_path, branch)
-            
             if not main_content:
                 logger.error(f"Main file {main_file_path} not found")
                 return False
             
             # Save the main file locally
-            os.makedirs(os.path.dirname(os.path.join(self.work_dir, main_file_path)), exist_ok=True)
-            with open(os.path.join(self.work_dir, main_file_path), 'w') as f:
-                f.write(main_content)
+            self._write_file(main_file_path, main_content)
             
             # Extract all include statements to find files we need
-            include_pattern = self.config.get("include_pattern", r"\\include{(.*?)}")
-            includes = re.findall(include_pattern, main_content)
+            includes = self._re_include.findall(main_content)
             
             # Add standard files we know we need
             files_to_download = [
                 "preamble.tex",
-                "macros/algebra.tex",
-                "macros/analysis.tex",
                 "bibliography.bib"
             ]
             
@@ -142,23 +223,32 @@ class CompilerAgent:
                     include = f"{include}.tex"
                 files_to_download.append(include)
             
-            # Download and save each file
-            for file_path in files_to_download:
-                content = self.github.get_file_content(file_path, branch)
-                if content:
-                    full_path = os.path.join(self.work_dir, file_path)
-                    os.makedirs(os.path.dirname(full_path), exist_ok=True)
-                    with open(full_path, 'w') as f:
-                        f.write(content)
-                    logger.info(f"Downloaded {file_path}")
+            # Add all macro files, plus chapter files that might not be included yet
+            files_to_download.extend(path for path in repo_paths if path.startswith("macros/"))
+            files_to_download.extend(self._chapter_paths(repo_paths))
+            
+            # Only request files that exist in the branch
+            text_files = []
+            for file_path in dict.fromkeys(files_to_download):
+                if file_path in available:
+                    text_files.append(file_path)
                 else:
                     logger.warning(f"File {file_path} not found, skipping")
             
-            # Also download all chapter files that might not be included yet
-            self.download_all_chapters(branch)
+            # Fetch all text files in one GraphQL round trip, falling back to
+            # REST for anything GraphQL didn't return
+            try:
+                contents = self.github.get_files_graphql(text_files, branch)
+            except Exception as e:
+                logger.warning(f"GraphQL download failed, using REST: {str(e)}")
+                contents = {}
+            for file_path, content in contents.items():
+                self._write_file(file_path, content)
+                logger.info(f"Downloaded {file_path}")
+            self._download_files([path for path in text_files if path not in contents], branch)
             
             # Download all figure files
-            self.download_figures(branch)
+            self.download_figures(branch, repo_paths)
             
             return True
             
@@ -166,43 +256,29 @@ class CompilerAgent:
             logger.error(f"Error downloading files: {str(e)}")
             return False
     
-    def download_all_chapters(self, branch="main"):
-        """
-        Download all chapter files from the repository
-        
-        Args:
-            branch (str): Branch to download from
-        """
-        # This is a simplified approach - in a real implementation,
-        # we would use GitHub API to list all files matching a pattern
-        # For now, we'll just try chapters 1-20
-        for chapter_num in range(1, 21):
-            chapter_path = f"chapters/chapter{chapter_num}.tex"
-            content = self.github.get_file_content(chapter_path, branch)
-            if content:
-                full_path = os.path.join(self.work_dir, chapter_path)
-                os.makedirs(os.path.dirname(full_path), exist_ok=True)
-                with open(full_path, 'w') as f:
-                    f.write(content)
-                logger.info(f"Downloaded {chapter_path}")
+    def _chapter_paths(self, repo_paths):
+        """Filter a file listing down to chapter files"""
+        return [path for path in repo_paths if self._re_chapter_path.fullmatch(path)]
     
-    def download_figures(self, branch="main"):
+    def download_figures(self, branch="main", repo_paths=None):
         """
         Download figure files from the repository
         
         Args:
             branch (str): Branch to download from
+            repo_paths (list, optional): File listing of the branch, if already fetched
         """
-        # In a real implementation, we would use GitHub API to list all files in figures directory
-        # For now, this is a placeholder that would need to be expanded
+        if repo_paths is None:
+            repo_paths = self.github.list_tree(branch)
+        
         figures_dir = "figures"
-        # This would actually require recursively listing the directory contents
-        # which is not directly supported in the current GitHub agent
-        logger.info("Figure downloading would be implemented here")
         
         # Create the figures directory in the working directory
         figures_path = os.path.join(self.work_dir, figures_dir)
         os.makedirs(figures_path, exist_ok=True)
+        
+        figure_paths = [path for path in repo_paths if path.startswith(f"{figures_dir}/")]
+        self._download_files(figure_paths, branch)
     
     def update_main_file(self):
         """
@@ -217,68 +293,50 @@ class CompilerAgent:
         
         try:
             # Path to the main file
-            main_file_path = os.path.join(self.work_dir, self.config.get("main_file", "main.tex"))
+            main_file_path = os.path.join(self.work_dir, self.main_file)
             
             # Read the current content
             with open(main_file_path, 'r') as f:
                 content = f.read()
             
             # Find all chapter files in the working directory
-            chapter_pattern = self.config.get("chapter_pattern", r"chapters/chapter(\d+)\.tex")
             available_chapters = []
             
             chapters_dir = os.path.join(self.work_dir, "chapters")
-            if os.path.exists(chapters_dir):
-                for file_name in os.listdir(chapters_dir):
-                    match = re.match(r"chapter(\d+)\.tex", file_name)
-                    if match:
-                        chapter_num = int(match.group(1))
-                        available_chapters.append((chapter_num, f"chapters/{file_name}"))
+            if os.path.isdir(chapters_dir):
+                with os.scandir(chapters_dir) as entries:
+                    for entry in entries:
+                        if not entry.is_file(follow_symlinks=False):
+                            continue
+                        match = self._re_chapter_file.match(entry.name)
+                        if match:
+                            chapter_num = int(match.group(1))
+                            available_chapters.append((chapter_num, f"chapters/{entry.name}"))
             
             # Sort chapters by number
             available_chapters.sort()
             
-            # Update the content to include all chapters
-            # Find the document environment
-            doc_start = content.find(r"\begin{document}")
-            doc_end = content.find(r"\end{document}")
-            
-            if doc_start == -1 or doc_end == -1:
+            # Split the file into everything up to \begin{document} (and the
+            # \tableofcontents line, if any), the body, and \end{document} onwards
+            match = self._re_doc.match(content)
+            if not match:
                 logger.error("Could not find document environment in main file")
                 return False
             
-            # Extract the preamble and document content
-            preamble = content[:doc_start + len(r"\begin{document}")]
-            doc_content = content[doc_start + len(r"\begin{document}"):doc_end]
-            
-            # Find table of contents and frontmatter
-            toc_pos = doc_content.find(r"\tableofcontents")
-            if toc_pos == -1:
-                # Insert after document start if not found
-                toc_pos = 0
-                frontmatter = ""
-            else:
-                # Find the next newline after tableofcontents
-                nl_pos = doc_content.find("\n", toc_pos)
-                if nl_pos == -1:
-                    nl_pos = len(doc_content)
-                frontmatter = doc_content[:nl_pos + 1]
-                doc_content = doc_content[nl_pos + 1:]
-            
             # Remove any existing chapter includes
-            include_pattern = self.config.get("include_pattern", r"\\include{chapters/chapter\d+}")
-            doc_content = re.sub(include_pattern, "", doc_content)
+            doc_content = self._re_include_strip.sub("", match["body"]).strip()
             
             # Create chapter includes
-            chapter_includes = "\n\n% Generated chapter includes\n"
-            for chapter_num, chapter_path in available_chapters:
-                # Strip .tex extension if it's there
-                if chapter_path.endswith(".tex"):
-                    chapter_path = chapter_path[:-4]
-                chapter_includes += f"\\include{{{chapter_path}}}\n"
+            parts = ["", "% Generated chapter includes"]
+            # Strip .tex extension if it's there
+            parts.extend(
+                f"\\include{{{path[:-4] if path.endswith('.tex') else path}}}"
+                for _, path in available_chapters
+            )
+            chapter_includes = "\n".join(parts) + "\n"
             
             # Reconstruct the document
-            new_content = f"{preamble}\n{frontmatter}\n{chapter_includes}\n{doc_content.strip()}\n\\end{{document}}\n"
+            new_content = "".join([match["pre"], chapter_includes, "\n", doc_content, "\n", match["post"]])
             
             # Write the updated content
             with open(main_file_path, 'w') as f:
@@ -291,6 +349,79 @@ class CompilerAgent:
             logger.error(f"Error updating main file: {str(e)}")
             return False
     
+    def _input_digest(self):
+        """
+        Hash every file in the working directory, plus the build commands
+        
+        Must be called before the first LaTeX pass, while the directory holds
+        only the downloaded inputs.
+        
+        Returns:
+            str: Hex digest identifying this set of inputs
+        """
+        h = hashlib.blake2b(digest_size=16)
+        h.update(f"{self.build_command_tmpl}\0{self.bibtex_command_tmpl}\0{self.run_bibtex}\0".encode("utf-8"))
+        
+        for root, dirs, files in os.walk(self.work_dir):
+            dirs.sort()
+            for file_name in sorted(files):
+                full_path = os.path.join(root, file_name)
+                h.update(os.path.relpath(full_path, self.work_dir).encode("utf-8") + b"\0")
+                with open(full_path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(65536), b""):
+                        h.update(chunk)
+                h.update(b"\0")
+        return h.hexdigest()
+    
+    def _aux_digest(self, main_name):
+        """
+        Hash the auxiliary files LaTeX reads back on the next pass
+        
+        Args:
+            main_name (str): Main file name without extension
+            
+        Returns:
+            bytes: Digest of the .aux, .toc and .out files
+        """
+        paths = sorted(glob.glob(os.path.join(self.work_dir, "**", "*.aux"), recursive=True))
+        paths += [os.path.join(self.work_dir, f"{main_name}{ext}") for ext in (".toc", ".out")]
+        
+        h = hashlib.blake2b(digest_size=16)
+        for path in paths:
+            h.update(path.encode("utf-8"))
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    h.update(f.read())
+        return h.digest()
+    
+    def _run_tool(self, argv, err_name, tail_bytes=4096):
+        """
+        Run a LaTeX tool in the working directory without buffering its output
+        
+        stdout is discarded and stderr goes to a file in the working directory,
+        so memory use doesn't grow with the size of the log.
+        
+        Args:
+            argv (list): Command to run
+            err_name (str): File name for the captured stderr
+            tail_bytes (int): How much of the end of stderr to return on failure
+            
+        Returns:
+            int: Exit code of the command
+            str: Last part of stderr if the command failed, otherwise ""
+        """
+        err_path = os.path.join(self.work_dir, err_name)
+        with open(err_path, 'wb') as err:
+            result = subprocess.run(argv, stdout=subprocess.DEVNULL, stderr=err, cwd=self.work_dir)
+        
+        if result.returncode == 0:
+            return result.returncode, ""
+        
+        with open(err_path, 'rb') as f:
+            f.seek(max(0, os.path.getsize(err_path) - tail_bytes))
+            tail = f.read().decode("utf-8", errors="replace")
+        return result.returncode, tail
+    
     def compile_book(self):
         """
         Compile the book using LaTeX
@@ -305,64 +436,70 @@ class CompilerAgent:
         
         try:
             # Path to the main file
-            main_file_path = os.path.join(self.work_dir, self.config.get("main_file", "main.tex"))
+            main_file_path = os.path.join(self.work_dir, self.main_file)
             main_name = os.path.splitext(os.path.basename(main_file_path))[0]
+            pdf_path = os.path.join(self.work_dir, f"{main_name}.pdf")
             
-            # Change to the working directory for compilation
-            original_dir = os.getcwd()
-            os.chdir(self.work_dir)
+            # Reuse the PDF from an earlier build of exactly the same inputs
+            cached_pdf = os.path.join(self.pdf_cache_dir, f"{self._input_digest()}.pdf")
+            if os.path.exists(cached_pdf):
+                shutil.copyfile(cached_pdf, pdf_path)
+                logger.info(f"Inputs unchanged, reusing cached PDF: {cached_pdf}")
+                return True, pdf_path
             
             # First LaTeX run
-            build_command = self.config.get("build_command", "pdflatex -interaction=nonstopmode {main_file}")
-            build_command = build_command.format(main_file=os.path.basename(main_file_path), main_name=main_name)
+            build_command = self.build_command_tmpl.format(main_file=os.path.basename(main_file_path), main_name=main_name)
+            build_argv = shlex.split(build_command)
             
             logger.info(f"Running first LaTeX pass: {build_command}")
-            result = subprocess.run(build_command, shell=True, capture_output=True, text=True)
+            returncode, stderr_tail = self._run_tool(build_argv, f"{main_name}.pass1.err")
             
-            if result.returncode != 0:
-                logger.error(f"LaTeX compilation failed: {result.stderr}")
+            if returncode != 0:
+                logger.error(f"LaTeX compilation failed: {stderr_tail}")
                 # Continue anyway, as some errors might be non-fatal
             
             # Run BibTeX if configured
-            if self.config.get("run_bibtex", True):
-                bibtex_command = self.config.get("bibtex_command", "bibtex {main_name}")
-                bibtex_command = bibtex_command.format(main_name=main_name)
+            if self.run_bibtex:
+                bibtex_command = self.bibtex_command_tmpl.format(main_name=main_name)
                 
                 logger.info(f"Running BibTeX: {bibtex_command}")
-                result = subprocess.run(bibtex_command, shell=True, capture_output=True, text=True)
+                returncode, stderr_tail = self._run_tool(shlex.split(bibtex_command), f"{main_name}.bibtex.err")
                 
-                if result.returncode != 0:
-                    logger.warning(f"BibTeX run had issues: {result.stderr}")
+                if returncode != 0:
+                    logger.warning(f"BibTeX run had issues: {stderr_tail}")
             
-            # Additional LaTeX runs to resolve references
-            latex_runs = self.config.get("latex_runs", 2)
+            # Additional LaTeX runs to resolve references, stopping early once
+            # the auxiliary files stop changing between passes
+            latex_runs = self.latex_runs
+            digest = self._aux_digest(main_name)
             for i in range(latex_runs):
                 logger.info(f"Running LaTeX pass {i+2}/{latex_runs+1}")
-                result = subprocess.run(build_command, shell=True, capture_output=True, text=True)
+                returncode, stderr_tail = self._run_tool(build_argv, f"{main_name}.pass{i+2}.err")
+                
+                if returncode != 0:
+                    logger.warning(f"LaTeX pass {i+2} had issues: {stderr_tail}")
                 
-                if result.returncode != 0:
-                    logger.warning(f"LaTeX pass {i+2} had issues: {result.stderr}")
+                previous_digest, digest = digest, self._aux_digest(main_name)
+                if digest == previous_digest:
+                    logger.info(f"References converged after LaTeX pass {i+2}")
+                    break
             
             # Check if PDF was generated
-            pdf_path = os.path.join(self.work_dir, f"{main_name}.pdf")
             if os.path.exists(pdf_path):
                 logger.info(f"Successfully compiled PDF: {pdf_path}")
-                # Change back to the original directory
-                os.chdir(original_dir)
+                try:
+                    os.makedirs(self.pdf_cache_dir, exist_ok=True)
+                    shutil.copyfile(pdf_path, f"{cached_pdf}.tmp")
+                    os.replace(f"{cached_pdf}.tmp", cached_pdf)
+                except OSError as e:
+                    logger.warning(f"Could not cache compiled PDF: {str(e)}")
                 return True, pdf_path
             else:
                 logger.error(f"PDF file not found at {pdf_path}")
-                # Change back to the original directory
-                os.chdir(original_dir)
                 return False, None
                 
         except Exception as e:
             logger.error(f"Error during compilation: {str(e)}")
-            # Ensure we change back to the original directory
-            try:
-                os.chdir(original_dir)
-            except:
-                pass
             return False, None
     
     def upload_compiled_book(self, pdf_path):
@@ -377,7 +514,7 @@ class CompilerAgent:
         """
         try:
             # Create or switch to the output branch
-            output_branch = self.config.get("output_branch", "compiled-output")
+            output_branch = self.output_branch
             
             # Check if branch exists
             branches = self.github.list_branches()
@@ -385,23 +522,24 @@ class CompilerAgent:
                 logger.info(f"Creating new branch: {output_branch}")
                 self.github.create_branch(output_branch)
             
-            # Read the PDF file
-            with open(pdf_path, 'rb') as f:
-                pdf_content = f.read()
+            # Stream the PDF up as a blob, then commit it together with the
+            # updated main file
+            pdf_blob_sha = self.github.create_blob(pdf_path)
+            pdf_repo_path = f"{self.output_dir}/{os.path.basename(pdf_path)}"
             
-            # We need to base64 encode the binary content
-            # Since the GitHubAgent.create_or_update_file method already does this,
-            # we'll need to update it to handle binary files properly
-            # For now, we'll just note this limitation
-            logger.warning("Binary file upload not fully implemented in GitHubAgent")
+            main_file = self.main_file
+            with open(os.path.join(self.work_dir, main_file), 'r') as f:
+                main_content = f.read()
             
-            # In a real implementation, we would:
-            # 1. Upload the PDF to the repository
-            # 2. Also upload the updated TeX files
-            # 3. Create a commit with all changes
+            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            self.github.commit_files(
+                output_branch,
+                {main_file: main_content},
+                f"Compiled book ({timestamp})",
+                blobs={pdf_repo_path: pdf_blob_sha}
+            )
             
-            # For now, just log success
-            logger.info(f"Would upload {pdf_path} to the repository (not implemented)")
+            logger.info(f"Uploaded {pdf_path} to {pdf_repo_path} on {output_branch}")
             return True
             
         except Exception as e:
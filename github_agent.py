@@ -11,12 +11,26 @@ Usage:
 """
 
 import os
+import asyncio
 import base64
+import sqlite3
+import threading
+import time
 import requests
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime
 import logging
 
+# orjson is optional; fall back to the standard library parser
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -25,10 +39,122 @@ logging.basicConfig(
 )
 logger = logging.getLogger("github_agent")
 
+class FileCache:
+    """Persistent ETag cache of file contents, with an in-process LRU in front"""
+    
+    def __init__(self, db_path, memory_size=512):
+        """
+        Initialize the cache
+        
+        Args:
+            db_path (str): Path to the SQLite database
+            memory_size (int): Number of files kept in memory for this process
+        """
+        db_path = os.path.expanduser(db_path)
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        
+        # Shared by the download threads, so serialize access
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS files "
+            "(key TEXT PRIMARY KEY, etag TEXT, content TEXT, last_seen REAL)"
+        )
+        self.db.commit()
+        
+        self.memory = OrderedDict()
+        self.memory_size = memory_size
+    
+    def get_memory(self, key):
+        """Return content already fetched by this process, or None"""
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+        return None
+    
+    def _remember(self, key, content):
+        """Add content to the in-process LRU (lock must be held)"""
+        self.memory[key] = content
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+    
+    def get(self, key):
+        """
+        Look up a stored file
+        
+        Returns:
+            tuple: (etag, content), or (None, None) if not stored
+        """
+        with self.lock:
+            row = self.db.execute("SELECT etag, content FROM files WHERE key = ?", (key,)).fetchone()
+        return row if row else (None, None)
+    
+    def hit(self, key, content):
+        """Record that a stored file was confirmed unchanged"""
+        with self.lock:
+            self.db.execute("UPDATE files SET last_seen = ? WHERE key = ?", (time.time(), key))
+            self.db.commit()
+            self._remember(key, content)
+    
+    def set(self, key, etag, content):
+        """Store a file and its ETag"""
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO files (key, etag, content, last_seen) VALUES (?, ?, ?, ?)",
+                (key, etag, content, time.time())
+            )
+            self.db.commit()
+            self._remember(key, content)
+    
+    def invalidate(self, key):
+        """Drop a file that has just been written"""
+        with self.lock:
+            self.memory.pop(key, None)
+            self.db.execute("DELETE FROM files WHERE key = ?", (key,))
+            self.db.commit()
+
+class _BlobUploadBody:
+    """
+    JSON request body for a base64 blob, streamed from a file on disk
+    
+    Iterating reopens the file, so the same body can be resent on a retry.
+    Having a length lets requests send it with Content-Length instead of
+    chunked transfer encoding.
+    """
+    
+    PREFIX = b'{"encoding": "base64", "content": "'
+    SUFFIX = b'"}'
+    
+    def __init__(self, local_path, chunk_size):
+        """
+        Initialize the body
+        
+        Args:
+            local_path (str): Path to the file on disk
+            chunk_size (int): Bytes read per chunk (a multiple of 3, so chunks
+                encode without padding)
+        """
+        self.local_path = local_path
+        self.chunk_size = chunk_size
+    
+    def __len__(self):
+        encoded = 4 * -(-os.path.getsize(self.local_path) // 3)
+        return len(self.PREFIX) + encoded + len(self.SUFFIX)
+    
+    def __iter__(self):
+        yield self.PREFIX
+        with open(self.local_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), b""):
+                yield base64.b64encode(chunk)
+        yield self.SUFFIX
+
 class GitHubAgent:
     """Agent for interacting with GitHub repositories"""
     
-    def __init__(self, repo_owner, repo_name, agent_name="ClaudeAgent"):
+    def __init__(self, repo_owner, repo_name, agent_name="ClaudeAgent", session=None,
+                 cache_path="~/.cache/agitnt/github_cache.sqlite"):
         """
         Initialize the GitHub agent
         
@@ -36,6 +162,8 @@ class GitHubAgent:
             repo_owner (str): Owner of the GitHub repository
             repo_name (str): Name of the GitHub repository
             agent_name (str): Name of the agent (used for commits and PRs)
+            session (requests.Session, optional): Shared HTTP session for connection reuse
+            cache_path (str, optional): SQLite file for the file content cache; None disables it
         """
         # Load environment variables
         load_dotenv()
@@ -53,26 +181,122 @@ class GitHubAgent:
             "Accept": "application/vnd.github.v3+json"
         }
         
+        # Reuse connections across requests instead of a new TLS handshake per call
+        self._owns_session = session is None
+        if session is None:
+            session = requests.Session()
+            retries = Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504])
+            session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=retries))
+        self.session = session
+        self.session.headers.update(self.headers)
+        
+        # Conditional requests against cached ETags skip unchanged downloads
+        self.file_cache = FileCache(cache_path) if cache_path else None
+        
+        # Short-lived cache of GET responses, cleared by any write
+        self.response_cache = OrderedDict()
+        self.response_cache_size = 256
+        self.response_cache_lock = threading.Lock()
+        
+        # Bounds concurrent async fetches; created per event loop on first use
+        self.async_concurrency = 10
+        self._async_semaphore = None
+        self._async_loop = None
+        
         logger.info(f"Initialized {agent_name} for {repo_owner}/{repo_name}")
     
-    def _make_request(self, method, endpoint, data=None, params=None):
-        """Make HTTP request to GitHub API"""
+    def close(self):
+        """Release the HTTP connection pool (if this agent created it) and the file cache"""
+        if self._owns_session:
+            self.session.close()
+        if self.file_cache:
+            with self.file_cache.lock:
+                self.file_cache.db.close()
+            self.file_cache = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def _send(self, method, endpoint, data=None, params=None, headers=None, retry_rate_limit=True, body=None):
+        """
+        Send an HTTP request to the GitHub API and return the raw response
+        
+        data is sent as JSON; body, if given instead, is sent as-is (it must be
+        re-iterable so a rate-limited request can be retried).
+        """
         url = f"{self.base_url}{endpoint}"
-        response = requests.request(
+        response = self.session.request(
             method=method,
             url=url,
-            headers=self.headers,
             json=data,
-            params=params
+            data=body,
+            params=params,
+            headers=headers
         )
         
-        # Handle rate limiting
-        if response.status_code == 403 and 'X-RateLimit-Remaining' in response.headers:
-            if int(response.headers['X-RateLimit-Remaining']) == 0:
-                logger.warning("GitHub API rate limit reached!")
+        # Handle rate limiting: wait for the window to reset and retry once
+        if response.status_code in (403, 429) and response.headers.get('X-RateLimit-Remaining') == "0":
+            reset = int(response.headers.get('X-RateLimit-Reset', 0))
+            wait = max(0, reset - time.time()) + 1
+            if retry_rate_limit:
+                logger.warning(f"GitHub API rate limit reached! Retrying in {wait:.0f}s")
+                time.sleep(wait)
+                return self._send(method, endpoint, data, params, headers, retry_rate_limit=False, body=body)
+            logger.warning("GitHub API rate limit reached!")
         
         response.raise_for_status()
-        return response.json() if response.content else None
+        return response
+    
+    def _make_request(self, method, endpoint, data=None, params=None, body=None, headers=None):
+        """Make HTTP request to GitHub API"""
+        response = self._send(method, endpoint, data=data, params=params, headers=headers, body=body)
+        
+        # Anything cached may be stale after a write
+        if method != "GET":
+            with self.response_cache_lock:
+                self.response_cache.clear()
+        
+        if not response.content:
+            return None
+        return orjson.loads(response.content) if orjson else response.json()
+    
+    def _get_cached(self, endpoint, params=None, ttl=60):
+        """
+        Make a GET request, reusing a recent identical response
+        
+        Args:
+            endpoint (str): API endpoint
+            params (dict, optional): Query parameters
+            ttl (float): Seconds a response stays valid
+            
+        Returns:
+            dict or list: Decoded JSON response
+        """
+        key = (endpoint, tuple(sorted((params or {}).items())))
+        now = time.time()
+        with self.response_cache_lock:
+            if key in self.response_cache:
+                stored_at, result = self.response_cache[key]
+                if now - stored_at < ttl:
+                    self.response_cache.move_to_end(key)
+                    return result
+                del self.response_cache[key]
+        
+        result = self._make_request("GET", endpoint, params=params)
+        
+        with self.response_cache_lock:
+            self.response_cache[key] = (now, result)
+            self.response_cache.move_to_end(key)
+            while len(self.response_cache) > self.response_cache_size:
+                self.response_cache.popitem(last=False)
+        return result
+    
+    def _cache_key(self, file_path, branch):
+        """Key for a file in the file content cache"""
+        return f"{self.repo_owner}/{self.repo_name}:{branch}:{file_path}"
     
     def get_file_content(self, file_path, branch="main"):
         """
@@ -85,15 +309,33 @@ class GitHubAgent:
         Returns:
             str: Decoded content of the file
         """
+        cache_key = self._cache_key(file_path, branch)
+        if self.file_cache:
+            content = self.file_cache.get_memory(cache_key)
+            if content is not None:
+                return content
+            etag, cached_content = self.file_cache.get(cache_key)
+        else:
+            etag, cached_content = None, None
+        
         try:
-            response = self._make_request(
+            response = self._send(
                 "GET", 
                 f"/contents/{file_path}", 
-                params={"ref": branch}
+                params={"ref": branch},
+                headers={"If-None-Match": etag} if etag else None
             )
             
+            # Unchanged since the cached copy (doesn't count against the rate limit)
+            if response.status_code == 304:
+                self.file_cache.hit(cache_key, cached_content)
+                logger.info(f"Retrieved {file_path} from {branch} (not modified)")
+                return cached_content
+            
             # Decode content from base64
-            content = base64.b64decode(response["content"]).decode("utf-8")
+            content = base64.b64decode(response.json()["content"]).decode("utf-8")
+            if self.file_cache and response.headers.get("ETag"):
+                self.file_cache.set(cache_key, response.headers["ETag"], content)
             logger.info(f"Retrieved {file_path} from {branch}")
             return content
         except requests.exceptions.HTTPError as e:
@@ -102,21 +344,174 @@ class GitHubAgent:
                 return None
             raise
     
-    def create_or_update_file(self, file_path, content, commit_message, branch="main", update=False):
+    def _get_async_semaphore(self):
+        """Get the semaphore bounding async requests on the running event loop"""
+        loop = asyncio.get_running_loop()
+        if self._async_loop is not loop:
+            self._async_semaphore = asyncio.Semaphore(self.async_concurrency)
+            self._async_loop = loop
+        return self._async_semaphore
+    
+    async def aget_file_content(self, file_path, branch="main"):
+        """
+        Async variant of get_file_content for fetching many files concurrently
+        
+        Runs the blocking request on a worker thread over the shared session,
+        with at most async_concurrency requests in flight.
+        
+        Args:
+            file_path (str): Path to the file
+            branch (str): Branch name
+            
+        Returns:
+            str: Decoded content of the file
+        """
+        async with self._get_async_semaphore():
+            return await asyncio.to_thread(self.get_file_content, file_path, branch)
+    
+    def download_file(self, file_path, dest_path, branch="main", chunk_size=65536):
+        """
+        Stream the raw content of a file straight to disk
+        
+        Nothing is base64-decoded or held in memory in full, so this suits
+        large and binary files alike.
+        
+        Args:
+            file_path (str): Path to the file in the repository
+            dest_path (str): Local path to write to
+            branch (str): Branch name
+            chunk_size (int): Bytes written per chunk
+            
+        Returns:
+            bool: True if the file was written, False if it doesn't exist
+        """
+        url = f"{self.base_url}/contents/{file_path}"
+        headers = {"Accept": "application/vnd.github.v3.raw"}
+        
+        with self.session.get(url, params={"ref": branch}, headers=headers, stream=True) as response:
+            if response.status_code == 404:
+                logger.warning(f"File {file_path} not found on branch {branch}")
+                return False
+            response.raise_for_status()
+            
+            with open(dest_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size):
+                    f.write(chunk)
+        
+        logger.info(f"Retrieved {file_path} from {branch}")
+        return True
+    
+    def get_files_graphql(self, paths, branch="main", batch_size=100):
+        """
+        Get the content of many text files with batched GraphQL queries
+        
+        Each query aliases one repository.object lookup per path, so a whole
+        batch of files costs a single round trip.
+        
+        Args:
+            paths (list): Paths to the files
+            branch (str): Branch name
+            batch_size (int): Maximum number of files per query
+            
+        Returns:
+            dict: Mapping of path to decoded content. Missing, binary and
+                truncated files are left out so callers can fall back to REST.
+        """
+        files = {}
+        paths = list(paths)
+        for start in range(0, len(paths), batch_size):
+            batch = paths[start:start + batch_size]
+            
+            # Pass expressions as variables so paths never need escaping
+            variables = {"owner": self.repo_owner, "name": self.repo_name}
+            declarations = ["$owner: String!", "$name: String!"]
+            fields = []
+            for i, path in enumerate(batch):
+                variables[f"e{i}"] = f"{branch}:{path}"
+                declarations.append(f"$e{i}: String!")
+                fields.append(f"f{i}: object(expression: $e{i}) {{ ... on Blob {{ text isBinary isTruncated }} }}")
+            query = (
+                f"query({', '.join(declarations)}) {{ "
+                f"repository(owner: $owner, name: $name) {{ {' '.join(fields)} }} }}"
+            )
+            
+            response = self.session.post(
+                "https://api.github.com/graphql",
+                json={"query": query, "variables": variables}
+            )
+            response.raise_for_status()
+            result = response.json()
+            if result.get("errors"):
+                logger.warning(f"GraphQL errors fetching files from {branch}: {result['errors']}")
+            
+            repository = (result.get("data") or {}).get("repository") or {}
+            for i, path in enumerate(batch):
+                blob = repository.get(f"f{i}")
+                if blob and blob.get("text") is not None and not blob["isBinary"] and not blob["isTruncated"]:
+                    files[path] = blob["text"]
+        
+        logger.info(f"Retrieved {len(files)} of {len(paths)} files from {branch} via GraphQL")
+        return files
+    
+    def get_file_sha(self, file_path, branch="main"):
+        """
+        Get the blob SHA of a file without downloading its content
+        
+        Args:
+            file_path (str): Path to the file
+            branch (str): Branch name
+            
+        Returns:
+            str: Blob SHA of the file, or None if it doesn't exist
+        """
+        # Listing the parent directory returns entry metadata only
+        parent_dir, file_name = os.path.split(file_path)
+        for entry in self.list_directory(parent_dir, branch):
+            if entry["name"] == file_name:
+                return entry["sha"]
+        return None
+    
+    def list_directory(self, path, branch="main"):
+        """
+        List the entries of a directory with a single Contents API call
+        
+        Args:
+            path (str): Path to the directory
+            branch (str): Branch name
+            
+        Returns:
+            list: Entry metadata (name, path, sha, type, ...), or an empty list
+                if the directory doesn't exist
+        """
+        try:
+            entries = self._get_cached(f"/contents/{path}", params={"ref": branch})
+        except requests.exceptions.HTTPError as e:
+            if e.response.status_code == 404:
+                logger.warning(f"Directory {path} not found on branch {branch}")
+                return []
+            raise
+        
+        # A file path returns a single object rather than a listing
+        return entries if isinstance(entries, list) else []
+    
+    def create_or_update_file(self, file_path, content, commit_message, branch="main", update=False, content_b64=None):
         """
         Create or update a file in the repository
         
         Args:
             file_path (str): Path to the file
-            content (str): Content to write to the file
+            content (str): Content to write to the file (ignored if content_b64 is given)
             commit_message (str): Commit message
             branch (str): Branch name
             update (bool): Whether to update existing file
+            content_b64 (str, optional): Content already base64-encoded by the caller
             
         Returns:
             dict: GitHub API response
         """
-        encoded_content = base64.b64encode(content.encode("utf-8")).decode("utf-8")
+        encoded_content = content_b64
+        if encoded_content is None:
+            encoded_content = base64.b64encode(content.encode("utf-8")).decode("ascii")
         data = {
             "message": commit_message,
             "content": encoded_content,
@@ -129,19 +524,128 @@ class GitHubAgent:
         
         # If updating, need the file's SHA
         if update:
-            file_info = self._make_request("GET", f"/contents/{file_path}", params={"ref": branch})
+            file_info = self._get_cached(f"/contents/{file_path}", params={"ref": branch})
             if file_info:
                 data["sha"] = file_info["sha"]
         
         response = self._make_request("PUT", f"/contents/{file_path}", data=data)
+        if self.file_cache:
+            self.file_cache.invalidate(self._cache_key(file_path, branch))
         logger.info(f"{'Updated' if update else 'Created'} {file_path} on {branch}")
         return response
     
+    def create_blob(self, local_path, chunk_size=3 * 21845):
+        """
+        Upload a local file as a Git blob without holding it in memory
+        
+        The request body is streamed: the file is read and base64-encoded
+        chunk by chunk as it is sent, so only one chunk is in memory at a time.
+        
+        Args:
+            local_path (str): Path to the file on disk
+            chunk_size (int): Bytes read per chunk (a multiple of 3, so chunks
+                encode without padding)
+            
+        Returns:
+            str: SHA of the new blob
+        """
+        blob_sha = self._make_request(
+            "POST",
+            "/git/blobs",
+            body=_BlobUploadBody(local_path, chunk_size),
+            headers={"Content-Type": "application/json"}
+        )["sha"]
+        logger.info(f"Uploaded {local_path} as blob {blob_sha[:7]}")
+        return blob_sha
+    
+    def commit_files(self, branch, files, message, blobs=None):
+        """
+        Commit several files to a branch as a single commit
+        
+        Uses the Git Data API: one blob per file (uploaded in parallel), one
+        tree on top of the branch's current tree, one commit, and one ref update.
+        
+        Args:
+            branch (str): Branch to commit to
+            files (dict): Mapping of repository path to content (str or bytes)
+            message (str): Commit message
+            blobs (dict, optional): Mapping of repository path to an already
+                uploaded blob SHA, e.g. from create_blob
+            
+        Returns:
+            dict: GitHub API response for the new commit
+        """
+        # Current head commit and its tree
+        head_sha = self._make_request("GET", f"/git/ref/heads/{branch}")["object"]["sha"]
+        base_tree_sha = self._make_request("GET", f"/git/commits/{head_sha}")["tree"]["sha"]
+        
+        # Upload blobs concurrently
+        def upload_blob(content):
+            if isinstance(content, str):
+                content = content.encode("utf-8")
+            data = {"content": base64.b64encode(content).decode("ascii"), "encoding": "base64"}
+            return self._make_request("POST", "/git/blobs", data=data)["sha"]
+        
+        paths = list(files)
+        with ThreadPoolExecutor(max_workers=min(8, len(paths)) or 1) as executor:
+            blob_shas = list(executor.map(upload_blob, (files[path] for path in paths)))
+        
+        if blobs:
+            paths.extend(blobs)
+            blob_shas.extend(blobs.values())
+        
+        tree = self._make_request("POST", "/git/trees", data={
+            "base_tree": base_tree_sha,
+            "tree": [
+                {"path": path, "mode": "100644", "type": "blob", "sha": sha}
+                for path, sha in zip(paths, blob_shas)
+            ]
+        })
+        
+        committer = {
+            "name": self.agent_name,
+            "email": f"{self.agent_name.lower()}@example.com"
+        }
+        commit = self._make_request("POST", "/git/commits", data={
+            "message": message,
+            "tree": tree["sha"],
+            "parents": [head_sha],
+            "author": committer,
+            "committer": committer
+        })
+        
+        self._make_request("PATCH", f"/git/refs/heads/{branch}", data={"sha": commit["sha"]})
+        if self.file_cache:
+            for path in paths:
+                self.file_cache.invalidate(self._cache_key(path, branch))
+        logger.info(f"Committed {len(paths)} files to {branch} in {commit['sha'][:7]}")
+        return commit
+    
     def list_branches(self):
         """List all branches in the repository"""
-        branches = self._make_request("GET", "/branches")
+        branches = self._get_cached("/branches")
         return [branch["name"] for branch in branches]
     
+    def list_tree(self, branch="main", recursive=True):
+        """
+        List every file path in a branch with a single Git Trees API call
+        
+        Args:
+            branch (str): Branch name
+            recursive (bool): Whether to include files in subdirectories
+            
+        Returns:
+            list: Paths of all files (blobs) in the branch
+        """
+        head_sha = self._make_request("GET", f"/git/ref/heads/{branch}")["object"]["sha"]
+        params = {"recursive": 1} if recursive else None
+        tree = self._make_request("GET", f"/git/trees/{head_sha}", params=params)
+        
+        if tree.get("truncated"):
+            logger.warning(f"Tree listing for {branch} was truncated by GitHub")
+        
+        return [entry["path"] for entry in tree["tree"] if entry["type"] == "blob"]
+    
     def create_branch(self, branch_name, base_branch="main"):
         """
         Create a new branch
@@ -214,6 +718,20 @@ class GitHubAgent:
         logger.info(f"Added comment to PR #{pr_number}")
         return response
     
+    async def acomment_on_pull_request(self, pr_number, comment):
+        """
+        Async variant of comment_on_pull_request for posting several comments at once
+        
+        Args:
+            pr_number (int): Pull request number
+            comment (str): Comment text
+            
+        Returns:
+            dict: GitHub API response
+        """
+        async with self._get_async_semaphore():
+            return await asyncio.to_thread(self.comment_on_pull_request, pr_number, comment)
+    
     def get_pull_request_comments(self, pr_number):
         """
         Get all comments on a pull request
@@ -240,7 +758,7 @@ class GitHubAgent:
             dict: GitHub API response
         """
         # Get the pull request to get the commit ID
-        pr_info = self._make_request("GET", f"/pulls/{pr_number}")
+        pr_info = self._get_cached(f"/pulls/{pr_number}")
         commit_id = pr_info["head"]["sha"]
         
         data = {
@@ -9,7 +9,6 @@ The agent:
 2. Analyzes the content for mathematical accuracy
 3. Provides feedback on clarity, examples, and pedagogy
 4. Suggests improvements via GitHub comments
-5. Can integrate feedback from multiple AI systems
 
 Usage:
     python reviewer_agent.py --repo-owner username --repo-name math-book-project --pr 42
@@ -21,11 +20,23 @@ import logging
 import sys
 import json
 import re
+import string
+import asyncio
+import functools
+import contextlib
+import copy
 import tempfile
 import anthropic
+from collections import defaultdict
 from github_agent import GitHubAgent
 from datetime import datetime
 
+# orjson is optional; fall back to the standard library parser
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -34,6 +45,110 @@ logging.basicConfig(
 )
 logger = logging.getLogger("reviewer_agent")
 
+SYSTEM_PROMPT = "You are an expert mathematician and educator reviewing a textbook chapter. Provide detailed, specific, and actionable feedback that maintains mathematical rigor while improving pedagogical effectiveness."
+
+DEFAULT_STYLE_GUIDE = """
+# Mathematical Writing Style Guide (Rudin/Atiyah Macdonald Academic Style)
+
+## Core Principles
+- Balance brevity with pedagogical clarity
+- Present definitions precisely, theorems rigorously
+- Provide intuition for complex concepts
+- Include carefully chosen examples that illustrate key points
+- Use consistent notation throughout
+
+## Structure
+- Begin with motivating examples or context
+- Present definitions before theorems
+- Group related concepts together
+- End sections with exercises that build understanding
+
+## Language
+- Prefer active voice for clarity
+- Use first-person plural ("we") rather than second-person
+- Maintain formal but accessible tone
+- Define terms before using them
+- Keep sentences direct and concise
+
+## Mathematical Presentation
+- State theorems clearly with all necessary conditions
+- Provide complete, rigorous proofs
+- Highlight key steps in proofs
+- Use examples to illustrate abstract concepts
+- Include diagrams where helpful
+"""
+
+REVIEW_INSTRUCTIONS = """
+# Review Task:
+Please review the chapter below carefully and provide specific feedback in the following categories:
+
+1. Mathematical Accuracy:
+   - Are all definitions, theorems, and proofs mathematically correct?
+   - Are there any logical errors or gaps in reasoning?
+   - Are all necessary conditions stated clearly?
+
+2. Pedagogical Clarity:
+   - Is the content explained clearly and accessibly?
+   - Are concepts introduced in a logical progression?
+   - Is there sufficient motivation for new concepts?
+
+3. Examples:
+   - Are the examples effective in illustrating the concepts?
+   - Are there enough examples of varying difficulty?
+   - Do examples show both standard cases and edge cases?
+
+4. Exercises:
+   - Are the exercises appropriate for reinforcing the material?
+   - Do they progress appropriately in difficulty?
+   - Do they cover all key concepts in the chapter?
+
+5. Notation and Consistency:
+   - Is notation used consistently throughout?
+   - Is the notation standard for the field?
+   - Are all symbols defined before use?
+
+For each category, provide:
+1. An overall assessment (Excellent, Good, Needs Improvement, Poor)
+2. Specific examples from the text to support your assessment
+3. Concrete suggestions for improvement
+
+Structure your feedback to be actionable, specific, and constructive. Include line numbers or section references where possible.
+"""
+
+REVIEW_MAX_TOKENS = 40000
+COMMENT_LIMIT = 60000
+
+# Closes the first comment when a review is posted in several parts
+SPLIT_NOTICE = "\n\nThis review is split into multiple comments due to length. See below for detailed feedback.\n"
+
+REVIEW_CATEGORIES = ["Mathematical Accuracy", "Pedagogical Clarity", "Examples", "Exercises", "Notation and Consistency"]
+
+# Review template placeholder prefix -> review category key
+TEMPLATE_CATEGORY_FIELDS = {
+    "math_accuracy": "mathematical_accuracy",
+    "pedagogical_clarity": "pedagogical_clarity",
+    "examples": "examples",
+    "exercises": "exercises",
+    "notation_consistency": "notation_consistency"
+}
+
+TEX_PATH_RE = re.compile(r"chapters/.*\.tex\Z", re.DOTALL)
+PR_TITLE_RE = re.compile(r"Chapter \d+:?\s*(.*?)$")
+SECTION_SPLIT_RE = re.compile(r"^#+[ \t]+(.+?)[ \t]*$", re.MULTILINE)
+RATING_RE = re.compile(r"\s*\*\*Rating\*\*:?\s+([^\n]+)")
+NEXT_HEADING_RE = re.compile(r"\n#+[ \t]")
+HEADING_LOOKBACK = 8
+LATEX_SECTION_SPLIT_RE = re.compile(r"(?=^\\section\{)", re.MULTILINE)
+SECTION_START_RE = re.compile(r"^\\(?:sub)*section\b", re.MULTILINE)
+CATEGORY_KEYS = {category.lower().replace(" ", "_") for category in REVIEW_CATEGORIES}
+
+@functools.lru_cache(maxsize=8)
+def _load_config_cached(config_path, mtime_ns):
+    """Parse a configuration file; the mtime key makes edits re-parse it"""
+    with open(config_path, 'rb') as f:
+        data = f.read()
+    return orjson.loads(data) if orjson else json.loads(data)
+
 class ReviewerAgent:
     """Agent for reviewing mathematical content"""
     
@@ -59,49 +174,24 @@ class ReviewerAgent:
         # Initialize Claude client if API key is available
         api_key = os.getenv("ANTHROPIC_API_KEY")
         if api_key:
-            self.anthropic_client = anthropic.Anthropic(api_key=api_key)
+            self.anthropic_client = anthropic.AsyncAnthropic(api_key=api_key)
         else:
             logger.warning("No Anthropic API key found, Claude integration unavailable")
             self.anthropic_client = None
         
-        # Initialize other AI clients if configured
-        self._initialize_other_ais()
+        # Prompt files fetched from the repository, loaded on first use
+        self._style_cache = None
+        self._template_cache = None
         
         logger.info(f"Initialized ReviewerAgent for {repo_owner}/{repo_name}")
     
-    def _initialize_other_ais(self):
-        """Initialize clients for other AI systems (Grok, OpenAI, etc.)"""
-        # This is a placeholder - in a real implementation, you would initialize
-        # the clients for other AI systems based on your configuration
-        
-        # Examples (not implemented):
-        # self.openai_client = None
-        # self.grok_client = None
-        
-        # If "other_ais" is in the config, try to initialize them
-        other_ais = self.config.get("other_ais", [])
-        for ai_config in other_ais:
-            ai_name = ai_config.get("name")
-            api_key_env = ai_config.get("api_key_env")
-            
-            if not ai_name or not api_key_env:
-                continue
-                
-            api_key = os.getenv(api_key_env)
-            if not api_key:
-                logger.warning(f"No API key found for {ai_name}, integration unavailable")
-                continue
-                
-            logger.info(f"Initialized {ai_name} integration")
-            
-            # In a real implementation, you would initialize the client here
-            # based on the AI system type
-    
     def load_config(self, config_path):
         """Load configuration from JSON file"""
         try:
-            with open(config_path, 'r') as f:
-                self.config = json.load(f)
+            # Reuse the parsed file across agents until it changes on disk; each
+            # agent gets its own copy so nested values can't leak between them
+            mtime_ns = os.stat(config_path).st_mtime_ns
+            self.config = copy.deepcopy(_load_config_cached(os.path.abspath(config_path), mtime_ns))
             logger.info(f"Loaded configuration from {config_path}")
         except FileNotFoundError:
             logger.warning(f"Configuration file {config_path} not found. Using defaults.")
@@ -117,25 +207,17 @@ class ReviewerAgent:
                     "notation_consistency"
                 ],
                 "detailed_feedback": True,
-                "other_ais": [
-                    {
-                        "name": "OpenAI",
-                        "api_key_env": "OPENAI_API_KEY",
-                        "model": "gpt-4",
-                        "review_categories": ["pedagogical_clarity", "examples"]
-                    },
-                    {
-                        "name": "Grok",
-                        "api_key_env": "GROK_API_KEY",
-                        "model": "grok-3",
-                        "review_categories": ["mathematical_accuracy", "notation_consistency"]
-                    }
-                ],
                 "review_template": "review_template.md"
             }
     
     def _get_style_guide(self):
         """Get the writing style guide"""
+        if self._style_cache is None:
+            self._style_cache = self._load_style_guide()
+        return self._style_cache
+    
+    def _load_style_guide(self):
+        """Load the writing style guide from the repository or the default"""
         style_path = self.config.get("style_guide", "math_style_guide.md")
         
         # Try to get from GitHub first
@@ -144,39 +226,16 @@ class ReviewerAgent:
             return content
         
         # If not found, return default style description
-        return """
-# Mathematical Writing Style Guide (Rudin/Atiyah Macdonald Academic Style)
-
-## Core Principles
-- Balance brevity with pedagogical clarity
-- Present definitions precisely, theorems rigorously
-- Provide intuition for complex concepts
-- Include carefully chosen examples that illustrate key points
-- Use consistent notation throughout
-
-## Structure
-- Begin with motivating examples or context
-- Present definitions before theorems
-- Group related concepts together
-- End sections with exercises that build understanding
-
-## Language
-- Prefer active voice for clarity
-- Use first-person plural ("we") rather than second-person
-- Maintain formal but accessible tone
-- Define terms before using them
-- Keep sentences direct and concise
-
-## Mathematical Presentation
-- State theorems clearly with all necessary conditions
-- Provide complete, rigorous proofs
-- Highlight key steps in proofs
-- Use examples to illustrate abstract concepts
-- Include diagrams where helpful
-"""
+        return DEFAULT_STYLE_GUIDE
     
     def _get_review_template(self):
         """Get the review template"""
+        if self._template_cache is None:
+            self._template_cache = self._load_review_template()
+        return self._template_cache
+    
+    def _load_review_template(self):
+        """Load the review template from the repository or the default"""
         template_path = self.config.get("review_template", "review_template.md")
         
         # Try to get from GitHub first
@@ -223,7 +282,7 @@ class ReviewerAgent:
 {summary}
 """
     
-    def get_pull_request_content(self, pr_number):
+    async def get_pull_request_content(self, pr_number):
         """
         Get the content of files in a pull request
         
@@ -231,7 +290,8 @@ class ReviewerAgent:
             pr_number (int): Pull request number
             
         Returns:
-            dict: Dictionary of files and their content
+            tuple: (dict of files and their content, chapter title), or
+                (None, None) on failure
         """
         try:
             # This would require additional GitHub API methods to:
@@ -245,7 +305,7 @@ class ReviewerAgent:
             pr_info = self.github._make_request("GET", f"/pulls/{pr_number}")
             if not pr_info:
                 logger.error(f"Could not find PR #{pr_number}")
-                return None
+                return None, None
             
             # Get the head branch
             head_branch = pr_info["head"]["ref"]
@@ -260,19 +320,27 @@ class ReviewerAgent:
             
             if not changed_files:
                 logger.error(f"Could not get files changed in PR #{pr_number}")
-                return None
+                return None, None
+            
+            # Only review tex files in the chapters directory
+            tex_paths = [file_info["filename"] for file_info in changed_files if TEX_PATH_RE.match(file_info["filename"])]
+            
+            # Fetch all of them in one GraphQL request
+            try:
+                contents = self.github.get_files_graphql(tex_paths, head_branch)
+            except Exception as e:
+                logger.warning(f"GraphQL fetch failed, using REST: {str(e)}")
+                contents = {}
+            
+            # Fall back to concurrent REST fetches for anything GraphQL didn't return
+            missing = [file_path for file_path in tex_paths if file_path not in contents]
+            if missing:
+                fetched = await asyncio.gather(*(self.github.aget_file_content(file_path, head_branch) for file_path in missing))
+                contents.update(zip(missing, fetched))
             
-            # Process each file
             result = {}
-            for file_info in changed_files:
-                file_path = file_info["filename"]
-                
-                # Skip non-tex files or files outside the chapters directory
-                if not file_path.endswith(".tex") or not file_path.startswith("chapters/"):
-                    continue
-                
-                # Get the content from the branch
-                content = self.github.get_file_content(file_path, head_branch)
+            for file_path in tex_paths:
+                content = contents.get(file_path)
                 if content:
                     result[file_path] = content
                 else:
@@ -280,130 +348,288 @@ class ReviewerAgent:
             
             if not result:
                 logger.error(f"No chapter files found in PR #{pr_number}")
-                return None
+                return None, None
             
             # Extract chapter title from PR title
             chapter_title = pr_title
-            match = re.match(r"Chapter \d+:?\s*(.*?)$", pr_title)
+            match = PR_TITLE_RE.match(pr_title)
             if match:
                 chapter_title = match.group(1).strip()
             
-            # Add PR title to the result
-            result["__pr_title__"] = chapter_title
-            
-            return result
+            return result, chapter_title
             
         except Exception as e:
             logger.error(f"Error getting PR content: {str(e)}")
-            return None
+            return None, None
     
-    def review_with_claude(self, content, chapter_title="Unknown"):
+    def _build_review_request(self, content, chapter_title):
         """
-        Use Claude to review the chapter content
+        Build the messages.create parameters for reviewing a chapter
         
         Args:
             content (str): Chapter content in LaTeX
             chapter_title (str): Title of the chapter
             
         Returns:
-            dict: Review results by category
+            dict: Keyword arguments for messages.create / messages.stream
         """
-        if not self.anthropic_client:
-            logger.error("Claude integration unavailable")
-            return None
-        
         # Get style guide
         style_guide = self._get_style_guide()
         
-        # Construct prompt for Claude
-        prompt = f"""
-You are reviewing a mathematics textbook chapter titled "{chapter_title}". 
+        # The style guide and rubric are the same for every PR, so they form a
+        # cached prefix; only the chapter itself is sent uncached
+        prompt_blocks = [
+            {
+                "type": "text",
+                "text": f"# Writing Style Guide:\n{style_guide}\n{REVIEW_INSTRUCTIONS}",
+                "cache_control": {"type": "ephemeral"}
+            },
+            {
+                "type": "text",
+                "text": f"""
+You are reviewing a mathematics textbook chapter titled "{chapter_title}".
 You're an expert mathematician and educator tasked with providing detailed, constructive feedback.
 
 # Chapter Content (LaTeX):
 ```latex
-{content[:50000]}  # Limit to avoid exceeding context window
+{content}
 ```
-
-# Writing Style Guide:
-{style_guide}
-
-# Review Task:
-Please review this chapter carefully and provide specific feedback in the following categories:
-
-1. Mathematical Accuracy:
-   - Are all definitions, theorems, and proofs mathematically correct?
-   - Are there any logical errors or gaps in reasoning?
-   - Are all necessary conditions stated clearly?
-
-2. Pedagogical Clarity:
-   - Is the content explained clearly and accessibly?
-   - Are concepts introduced in a logical progression?
-   - Is there sufficient motivation for new concepts?
-
-3. Examples:
-   - Are the examples effective in illustrating the concepts?
-   - Are there enough examples of varying difficulty?
-   - Do examples show both standard cases and edge cases?
-
-4. Exercises:
-   - Are the exercises appropriate for reinforcing the material?
-   - Do they progress appropriately in difficulty?
-   - Do they cover all key concepts in the chapter?
-
-5. Notation and Consistency:
-   - Is notation used consistently throughout?
-   - Is the notation standard for the field?
-   - Are all symbols defined before use?
-
-For each category, provide:
-1. An overall assessment (Excellent, Good, Needs Improvement, Poor)
-2. Specific examples from the text to support your assessment
-3. Concrete suggestions for improvement
-
-Structure your feedback to be actionable, specific, and constructive. Include line numbers or section references where possible.
 """
-
+            }
+        ]
+        
+        return {
+            "model": self.config.get("model", "claude-3-7-sonnet-20250219"),
+            "max_tokens": REVIEW_MAX_TOKENS,
+            "temperature": 0.0,  # Use zero temperature for more consistent reviews
+            "system": [{"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}],
+            "messages": [{"role": "user", "content": prompt_blocks}]
+        }
+    
+    async def _count_request_tokens(self, content, chapter_title):
+        """Count the input tokens of a review request for the given content"""
+        params = self._build_review_request(content, chapter_title)
+        result = await self.anthropic_client.messages.count_tokens(
+            model=params["model"],
+            system=params["system"],
+            messages=params["messages"]
+        )
+        return result.input_tokens
+    
+    async def _truncate_to_budget(self, content, chapter_title):
+        """
+        Cut the chapter to the largest prefix that fits the input token budget
+        
+        Cuts fall on \\section/\\subsection boundaries so no theorem or proof is
+        split; the longest fitting prefix is found by binary search with the
+        token counting endpoint.
+        
+        Args:
+            content (str): Chapter content in LaTeX
+            chapter_title (str): Title of the chapter
+            
+        Returns:
+            str: The content, truncated if necessary
+        """
+        budget = self.config.get("context_window", 200000) - REVIEW_MAX_TOKENS
+        
         try:
-            # Generate review using Claude
-            logger.info(f"Generating review for chapter '{chapter_title}' using Claude")
-            response = self.anthropic_client.messages.create(
-                model=self.config.get("model", "claude-3-7-sonnet-20250219"),
-                max_tokens=40000,
-                temperature=0.0,  # Use zero temperature for more consistent reviews
-                system="You are an expert mathematician and educator reviewing a textbook chapter. Provide detailed, specific, and actionable feedback that maintains mathematical rigor while improving pedagogical effectiveness.",
-                messages=[{"role": "user", "content": prompt}]
+            total_tokens = await self._count_request_tokens(content, chapter_title)
+            if total_tokens <= budget:
+                return content
+            
+            # Candidate cut points, shortest first
+            cuts = [match.start() for match in SECTION_START_RE.finditer(content) if match.start() > 0]
+            
+            # Largest cut whose prefix fits
+            best = None
+            low, high = 0, len(cuts) - 1
+            while low <= high:
+                mid = (low + high) // 2
+                if await self._count_request_tokens(content[:cuts[mid]], chapter_title) <= budget:
+                    best = cuts[mid]
+                    low = mid + 1
+                else:
+                    high = mid - 1
+            
+            if best is None:
+                # No section boundary fits; cut at a line using the observed
+                # characters-per-token ratio, with some headroom
+                limit = int(len(content) * budget / total_tokens * 0.9)
+                best = content.rfind("\n", 0, limit)
+                if best <= 0:
+                    # No line break in range (e.g. minified LaTeX); cut mid-line
+                    best = limit
+            
+            logger.warning(
+                f"Chapter is {total_tokens} tokens, over the {budget} token budget; "
+                f"reviewing the first {best} of {len(content)} characters"
             )
+            return content[:best]
+        
+        except Exception as e:
+            logger.warning(f"Token counting failed, truncating by characters: {str(e)}")
+            return content[:50000]
+    
+    async def review_with_claude(self, content, chapter_title="Unknown"):
+        """
+        Use Claude to review the chapter content
+        
+        Args:
+            content (str): Chapter content in LaTeX
+            chapter_title (str): Title of the chapter
             
-            # Extract content from response
-            review_content = response.content[0].text
+        Returns:
+            dict: Review results by category
+        """
+        if not self.anthropic_client:
+            logger.error("Claude integration unavailable")
+            return None
+        
+        # Chapters too long for one request are reviewed section by section;
+        # every part shares the cached style guide and rubric prefix
+        parts, fits = await self._split_for_review(content, chapter_title)
+        if len(parts) == 1:
+            return await self._review_part(parts[0], chapter_title, truncate=not fits)
+        
+        logger.info(f"Reviewing chapter '{chapter_title}' in {len(parts)} parts")
+        titles = [f"{chapter_title} (part {i} of {len(parts)})" for i in range(1, len(parts) + 1)]
+        
+        # The first part writes the prompt cache; the rest then read it in parallel
+        # (concurrent requests started before the write would each miss and re-write it)
+        first = await self._review_part(parts[0], titles[0])
+        rest = await asyncio.gather(*(
+            self._review_part(part, title) for part, title in zip(parts[1:], titles[1:])
+        ))
+        return self._merge_part_reviews([first, *rest])
+    
+    async def _split_for_review(self, content, chapter_title):
+        """
+        Split a chapter into parts that each fit the input token budget
+        
+        Args:
+            content (str): Chapter content in LaTeX
+            chapter_title (str): Title of the chapter
             
-            # Parse review into categories
-            # This is a simplified parsing - in a real implementation, you'd want
-            # to use more robust parsing based on the actual structure of Claude's response
-            categories = {}
+        Returns:
+            list: Chapter parts, split on \\section boundaries
+            bool: Whether the single part is known to fit already
+        """
+        budget = self.config.get("context_window", 200000) - REVIEW_MAX_TOKENS
+        
+        try:
+            total_tokens = await self._count_request_tokens(content, chapter_title)
+        except Exception as e:
+            logger.warning(f"Token counting failed, reviewing in one request: {str(e)}")
+            return [content], False
+        
+        if total_tokens <= budget:
+            return [content], True
+        
+        # Greedily pack whole sections into parts, estimating their size from
+        # the chapter's overall characters-per-token ratio with some headroom
+        part_chars = int(len(content) * budget / total_tokens * 0.8)
+        parts = []
+        current = []
+        current_len = 0
+        for section in LATEX_SECTION_SPLIT_RE.split(content):
+            if current and current_len + len(section) > part_chars:
+                parts.append("".join(current))
+                current = []
+                current_len = 0
+            current.append(section)
+            current_len += len(section)
+        if current:
+            parts.append("".join(current))
+        return parts, False
+    
+    def _merge_part_reviews(self, reviews):
+        """
+        Merge the reviews of a chapter's parts category by category
+        
+        Args:
+            reviews (list): Review results for each part, in order
             
-            # Extract overall assessment
-            overall_match = re.search(r"# Overall Assessment\s+(.*?)(?=\s+#|$)", review_content, re.DOTALL)
-            if overall_match:
-                categories["overall"] = overall_match.group(1).strip()
+        Returns:
+            dict: Combined review results by category
+        """
+        merged = {}
+        full_reviews = []
+        overall = []
+        for i, review in enumerate(reviews, 1):
+            if not review:
+                continue
+            label = f"Part {i}"
             
-            # Extract category-specific feedback
-            for category in ["Mathematical Accuracy", "Pedagogical Clarity", "Examples", "Exercises", "Notation and Consistency"]:
-                category_key = category.lower().replace(" ", "_")
-                
-                # Look for the category heading
-                pattern = rf"# {re.escape(category)}\s+(?:\*\*Rating\*\*:?\s+([^\n]+))?\s+(.*?)(?=\s+#|$)"
-                match = re.search(pattern, review_content, re.DOTALL)
-                
-                if match:
-                    rating = match.group(1).strip() if match.group(1) else "No rating provided"
-                    feedback = match.group(2).strip()
-                    
-                    categories[category_key] = {
-                        "rating": rating,
-                        "feedback": feedback
-                    }
+            full_reviews.append(f"# {label}\n\n{review.get('full_review', '')}")
+            if "overall" in review:
+                overall.append(f"**{label}:** {review['overall']}")
+            
+            for category in REVIEW_CATEGORIES:
+                key = category.lower().replace(" ", "_")
+                if key not in review:
+                    continue
+                entry = merged.setdefault(key, {"ratings": [], "feedback": []})
+                entry["ratings"].append(f"{label}: {review[key]['rating']}")
+                entry["feedback"].append(f"**{label}:**\n{review[key]['feedback']}")
+        
+        if not full_reviews:
+            return None
+        
+        for key, entry in merged.items():
+            merged[key] = {
+                "rating": "; ".join(entry["ratings"]),
+                "feedback": "\n\n".join(entry["feedback"])
+            }
+        if overall:
+            merged["overall"] = "\n\n".join(overall)
+        merged["full_review"] = "\n\n".join(full_reviews)
+        return merged
+    
+    async def _review_part(self, content, chapter_title, truncate=True):
+        """
+        Review a chapter, or one part of it, with a single Claude request
+        
+        Args:
+            content (str): Chapter content in LaTeX
+            chapter_title (str): Title of the chapter
+            truncate (bool): Whether to cut the content to the token budget first
+            
+        Returns:
+            dict: Review results by category
+        """
+        # Fit as much of the content as the context window allows
+        if truncate:
+            content = await self._truncate_to_budget(content, chapter_title)
+        params = self._build_review_request(content, chapter_title)
+        
+        try:
+            # Generate review using Claude, parsing each section as soon as the
+            # next heading arrives instead of waiting for the whole response
+            logger.info(f"Generating review for chapter '{chapter_title}' using Claude")
+            categories = {}
+            completed = []
+            section = ""
+            async with self.anthropic_client.messages.stream(**params) as stream:
+                async for text in stream.text_stream:
+                    # Re-check a few characters back in case a heading marker
+                    # straddles two chunks
+                    start = max(1, len(section) - HEADING_LOOKBACK)
+                    section += text
+                    match = NEXT_HEADING_RE.search(section, start)
+                    while match:
+                        cut = match.start() + 1
+                        self._merge_sections(categories, section[:cut])
+                        completed.append(section[:cut])
+                        section = section[cut:]
+                        match = NEXT_HEADING_RE.search(section, 1)
+                response = await stream.get_final_message()
+            self._log_cache_usage(response)
+            
+            # Parse the final section
+            self._merge_sections(categories, section)
+            completed.append(section)
+            review_content = "".join(completed)
             
             # If we couldn't parse structured categories, return the full review
             if not categories:
@@ -418,59 +644,64 @@ Structure your feedback to be actionable, specific, and constructive. Include li
             logger.error(f"Error generating review with Claude: {str(e)}")
             return None
     
-    def review_with_other_ai(self, content, chapter_title, ai_config):
+    def _parse_review(self, review_content):
         """
-        Use another AI system to review the chapter content
+        Parse a review into its assessment categories in a single pass
+        
+        The text is split once on its markdown headings; each heading that
+        names a review category claims the body up to the next heading.
         
         Args:
-            content (str): Chapter content in LaTeX
-            chapter_title (str): Title of the chapter
-            ai_config (dict): Configuration for the AI system
+            review_content (str): Review text returned by the model
             
         Returns:
-            dict: Review results
+            dict: Overall assessment and per-category rating/feedback
         """
-        # This is a placeholder - in a real implementation, you would
-        # integrate with the specific AI system based on your configuration
+        categories = {}
         
-        ai_name = ai_config.get("name", "Unknown AI")
-        logger.info(f"Would review with {ai_name} (not implemented)")
+        # Split yields [preamble, heading1, body1, heading2, body2, ...]
+        parts = SECTION_SPLIT_RE.split(review_content)
+        for heading, body in zip(parts[1::2], parts[2::2]):
+            key = heading.strip().lower().replace(" ", "_")
+            
+            if key == "overall_assessment":
+                categories.setdefault("overall", body.strip())
+            elif key in CATEGORY_KEYS and key not in categories:
+                rating_match = RATING_RE.match(body)
+                if rating_match:
+                    rating = rating_match.group(1).strip()
+                    body = body[rating_match.end():]
+                else:
+                    rating = "No rating provided"
+                
+                categories[key] = {
+                    "rating": rating,
+                    "feedback": body.strip()
+                }
         
-        # Return a placeholder result
-        return {
-            "rating": "Not Implemented",
-            "feedback": f"Review with {ai_name} is not implemented yet."
-        }
+        return categories
     
-    def combine_reviews(self, claude_review, other_reviews):
-        """
-        Combine reviews from different AI systems
-        
-        Args:
-            claude_review (dict): Review from Claude
-            other_reviews (dict): Reviews from other AI systems
-            
-        Returns:
-            dict: Combined review
-        """
-        # Start with Claude's review as the base
-        combined = claude_review.copy() if claude_review else {}
+    def _merge_sections(self, categories, text):
+        """Parse completed review sections, keeping the first occurrence of each category"""
+        for key, value in self._parse_review(text).items():
+            categories.setdefault(key, value)
+    
+    def _log_cache_usage(self, response):
+        """Log prompt cache statistics reported by the API"""
+        usage = getattr(response, "usage", None)
+        if not usage:
+            return
         
-        # Add insights from other AI systems
-        for ai_name, review in other_reviews.items():
-            if not review:
-                continue
-                
-            # For each review category, add insights from this AI
-            for category, content in review.items():
-                category_key = f"{category}_insights"
-                
-                if category_key not in combined:
-                    combined[category_key] = {}
-                
-                combined[category_key][ai_name] = content
+        cache_read = getattr(usage, "cache_read_input_tokens", 0) or 0
+        cache_write = getattr(usage, "cache_creation_input_tokens", 0) or 0
+        uncached = getattr(usage, "input_tokens", 0) or 0
+        total = cache_read + cache_write + uncached
         
-        return combined
+        if total:
+            logger.info(
+                f"Prompt cache: {cache_read} read, {cache_write} written, {uncached} uncached "
+                f"input tokens ({100 * cache_read / total:.1f}% hit rate)"
+            )
     
     def format_review_for_comment(self, review, chapter_title):
         """
@@ -481,37 +712,36 @@ Structure your feedback to be actionable, specific, and constructive. Include li
             chapter_title (str): Title of the chapter
             
         Returns:
-            list: List of comments to post
+            list: List of comments to post, each within GitHub's length limit
         """
-        # If we have a full review, just return it
+        # If we have a full review, just return it (split if it's too long)
         if "full_review" in review and not self.config.get("detailed_feedback", True):
-            return [review["full_review"]]
+            return self._pack_comments([review["full_review"]])
         
         # Otherwise, format a structured review
         template = self._get_review_template()
         
-        # Format the overall review
-        formatted_review = template.format(
-            chapter_title=chapter_title,
-            overall_assessment=review.get("overall", "No overall assessment provided."),
-            math_accuracy_rating=review.get("mathematical_accuracy", {}).get("rating", "Not rated"),
-            math_accuracy_feedback=review.get("mathematical_accuracy", {}).get("feedback", "No feedback provided."),
-            pedagogical_clarity_rating=review.get("pedagogical_clarity", {}).get("rating", "Not rated"),
-            pedagogical_clarity_feedback=review.get("pedagogical_clarity", {}).get("feedback", "No feedback provided."),
-            examples_rating=review.get("examples", {}).get("rating", "Not rated"),
-            examples_feedback=review.get("examples", {}).get("feedback", "No feedback provided."),
-            exercises_rating=review.get("exercises", {}).get("rating", "Not rated"),
-            exercises_feedback=review.get("exercises", {}).get("feedback", "No feedback provided."),
-            notation_consistency_rating=review.get("notation_consistency", {}).get("rating", "Not rated"),
-            notation_consistency_feedback=review.get("notation_consistency", {}).get("feedback", "No feedback provided."),
-            specific_suggestions=review.get("specific_suggestions", "No specific suggestions provided."),
-            summary=review.get("summary", "No summary provided.")
-        )
+        # Flatten the review into template fields; placeholders a custom
+        # template uses that we don't know about render as "Not provided"
+        fields = defaultdict(lambda: "Not provided")
+        fields["chapter_title"] = chapter_title
+        fields["overall_assessment"] = review.get("overall", "No overall assessment provided.")
+        for field, key in TEMPLATE_CATEGORY_FIELDS.items():
+            category = review.get(key) or {}
+            fields[f"{field}_rating"] = category.get("rating", "Not rated")
+            fields[f"{field}_feedback"] = category.get("feedback", "No feedback provided.")
+        fields["specific_suggestions"] = review.get("specific_suggestions", "No specific suggestions provided.")
+        fields["summary"] = review.get("summary", "No summary provided.")
         
-        # Split into sections if the review is too long for a single comment
-        # GitHub has a limit of around 65536 characters per comment
-        if len(formatted_review) < 60000:
-            return [formatted_review]
+        # The template's literal text plus the fields it references gives the
+        # rendered length without rendering; GitHub has a limit of around
+        # 65536 characters per comment
+        rendered_length = sum(
+            len(literal) + (len(str(fields[name])) if name is not None else 0)
+            for literal, name, _, _ in string.Formatter().parse(template)
+        )
+        if rendered_length < COMMENT_LIMIT:
+            return [template.format_map(fields)]
         
         # Split into sections
         sections = []
@@ -522,8 +752,6 @@ Structure your feedback to be actionable, specific, and constructive. Include li
 
 ## Overall Assessment
 {review.get("overall", "No overall assessment provided.")}
-
-This review is split into multiple comments due to length. See below for detailed feedback.
 """
         sections.append(overview)
         
@@ -558,9 +786,54 @@ This review is split into multiple comments due to length. See below for detaile
                 
             sections.append(final_section)
         
-        return sections
+        # Merge short sections and split long ones so each comment fits with as
+        # few comments (and notifications) as possible, leaving room to point
+        # readers to the other comments if there are any
+        comments = self._pack_comments(sections, COMMENT_LIMIT - len(SPLIT_NOTICE))
+        if len(comments) > 1:
+            comments[0] += SPLIT_NOTICE
+        return comments
     
-    def post_review_comments(self, pr_number, review, chapter_title):
+    def _pack_comments(self, sections, max_len=COMMENT_LIMIT):
+        """
+        Greedily join consecutive sections into as few comments as fit
+        
+        Args:
+            sections (list): Comment sections, in order
+            max_len (int): Maximum length of one comment
+            
+        Returns:
+            list: Comments, each a run of sections joined by blank lines;
+                sections longer than max_len are cut at line breaks first
+        """
+        comments = []
+        current = []
+        current_len = 0
+        for section in self._split_oversized(sections, max_len):
+            added = len(section) + (2 if current else 0)
+            if current and current_len + added > max_len:
+                comments.append("\n\n".join(current))
+                current = []
+                current_len = 0
+                added = len(section)
+            current.append(section)
+            current_len += added
+        if current:
+            comments.append("\n\n".join(current))
+        return comments
+    
+    def _split_oversized(self, sections, max_len):
+        """Yield sections, cutting any longer than max_len at line breaks"""
+        for section in sections:
+            while len(section) > max_len:
+                cut = section.rfind("\n", 0, max_len)
+                if cut <= 0:
+                    cut = max_len
+                yield section[:cut]
+                section = section[cut:].lstrip("\n")
+            yield section
+    
+    async def post_review_comments(self, pr_number, review, chapter_title):
         """
         Post review comments to the pull request
         
@@ -580,13 +853,10 @@ This review is split into multiple comments due to length. See below for detaile
                 logger.error("No comments to post")
                 return False
             
-            # Post each comment
+            # Post one at a time so the parts keep their order in the thread,
+            # without blocking the event loop between requests
             for comment in comments:
-                # Truncate if too long (GitHub has limits)
-                if len(comment) > 60000:
-                    comment = comment[:59997] + "..."
-                
-                self.github.comment_on_pull_request(pr_number, comment)
+                await self.github.acomment_on_pull_request(pr_number, comment)
             
             logger.info(f"Posted {len(comments)} review comments to PR #{pr_number}")
             return True
@@ -633,8 +903,11 @@ This review is split into multiple comments due to length. See below for detaile
             suggested_changes (dict): Suggested changes by line number
             
         Returns:
-            str: Path to the diff file
+            str: Path to the diff file, or None if there are no changes
         """
+        if not suggested_changes:
+            return None
+        
         # This is a more advanced feature that would require:
         # 1. Parsing the original content into lines
         # 2. Applying the suggested changes
@@ -676,6 +949,18 @@ Suggested: \add{$f(x) = x^2 + C$}
         """
         Review a pull request
         
+        Args:
+            pr_number (int): Pull request number
+            
+        Returns:
+            bool: Success status
+        """
+        return asyncio.run(self.review_pull_request_async(pr_number))
+    
+    async def review_pull_request_async(self, pr_number):
+        """
+        Review a pull request
+        
         Args:
             pr_number (int): Pull request number
             
@@ -684,50 +969,41 @@ Suggested: \add{$f(x) = x^2 + C$}
         """
         try:
             # Get the content of the pull request
-            content = self.get_pull_request_content(pr_number)
+            content, chapter_title = await self.get_pull_request_content(pr_number)
             if not content:
                 logger.error("Failed to get pull request content")
                 return False
             
-            # Extract chapter title
-            chapter_title = content.pop("__pr_title__", "Unknown Chapter")
-            
             # Combine all chapter files into a single text for review
-            combined_content = ""
+            parts = []
             for file_path, file_content in content.items():
-                combined_content += f"\n% File: {file_path}\n{file_content}\n"
+                parts.append(f"\n% File: {file_path}\n")
+                parts.append(file_content)
+                parts.append("\n")
+            combined_content = "".join(parts)
             
             # Review with Claude
-            claude_review = self.review_with_claude(combined_content, chapter_title)
-            
-            # Review with other AI systems if configured
-            other_reviews = {}
-            for ai_config in self.config.get("other_ais", []):
-                ai_name = ai_config.get("name")
-                if not ai_name:
-                    continue
-                    
-                review = self.review_with_other_ai(combined_content, chapter_title, ai_config)
-                if review:
-                    other_reviews[ai_name] = review
-            
-            # Combine the reviews
-            combined_review = self.combine_reviews(claude_review, other_reviews)
+            try:
+                review = await self.review_with_claude(combined_content, chapter_title) or {}
+            except Exception as e:
+                logger.error(f"Error generating review with Claude: {str(e)}")
+                review = {}
             
             # Post the review comments
-            success = self.post_review_comments(pr_number, combined_review, chapter_title)
+            success = await self.post_review_comments(pr_number, review, chapter_title)
             
             # Add inline comments if configured
             if self.config.get("inline_comments", False):
-                self.add_inline_comments(pr_number, combined_review, content)
+                self.add_inline_comments(pr_number, review, content)
             
             # Create and upload a LaTeX diff if configured
-            if self.config.get("latex_diff", False) and "suggested_changes" in combined_review:
-                diff_path = self.create_latex_diff(combined_content, combined_review["suggested_changes"])
+            if self.config.get("latex_diff", False) and review.get("suggested_changes"):
+                diff_path = self.create_latex_diff(combined_content, review["suggested_changes"])
                 if diff_path:
                     # Upload the diff file
                     # In a real implementation, you would upload this to the repository
-                    os.remove(diff_path)
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(diff_path)
             
             return success
             
@@ -753,8 +1029,9 @@ def main():
         config_path=args.config
     )
     
-    # Review the pull request
-    success = agent.review_pull_request(args.pr)
+    # Review the pull request, then release the GitHub connection pool
+    with agent.github:
+        success = agent.review_pull_request(args.pr)
     
     if success:
         print(f"Successfully reviewed PR #{args.pr}")